@@ -2,7 +2,8 @@ SET FOREIGN_KEY_CHECKS = 0;
 DROP TABLE IF EXISTS Author;
 CREATE TABLE Author (
     AuthorID INTEGER PRIMARY KEY NOT NULL auto_increment,
-    AName TEXT NOT NULL
+    AName VARCHAR(255) NOT NULL,
+    INDEX ix_Author_AName (AName)
 );
 DROP TABLE IF EXISTS WroteBy;
 CREATE TABLE WroteBy (
@@ -17,7 +18,8 @@ CREATE TABLE WroteBy (
 DROP TABLE IF EXISTS KeyWord;
 CREATE TABLE KeyWord (
     KeyWordID INTEGER PRIMARY KEY NOT NULL auto_increment,
-    KeyWord TEXT NOT NULL
+    KeyWord VARCHAR(255) COLLATE utf8mb4_bin NOT NULL,
+    UNIQUE INDEX ux_KeyWord_KeyWord (KeyWord)
 );
 DROP TABLE IF EXISTS HasKeyWord;
 CREATE TABLE HasKeyWord (
@@ -49,26 +51,62 @@ CREATE TABLE Articles (
     NewsSourceID INTEGER,
     ArticleText TEXT,
     ArticleSummary TEXT NOT NULL,
+    INDEX ix_Articles_PublishDate (PublishDate),
+    INDEX ix_Articles_NewsSourceID_AName (NewsSourceID, AName(255)),
+    INDEX ix_Articles_URL (URL(255)),
     FOREIGN KEY (NewsSourceID)
 		REFERENCES NewsSource(NewsSourceID)
 );
 DROP TABLE IF EXISTS NewsSource;
 CREATE TABLE NewsSource (
     NewsSourceID INTEGER NOT NULL PRIMARY KEY auto_increment,
-    NewsSourceName TEXT NOT NULL,
+    NewsSourceName VARCHAR(255) NOT NULL,
     Homepage TEXT NOT NULL,
     BiasID INTEGER,
+    UNIQUE INDEX ux_NewsSource_NewsSourceName (NewsSourceName),
     FOREIGN KEY (BiasID)
 		REFERENCES BiasType(BiasID)
 );
+DROP TABLE IF EXISTS StagingArticle;
+CREATE TABLE StagingArticle (
+    StageID INTEGER NOT NULL PRIMARY KEY,
+    NewsSourceName TEXT NOT NULL,
+    Homepage TEXT NOT NULL,
+    BiasID INTEGER,
+    Title TEXT NOT NULL,
+    URL TEXT NOT NULL,
+    PublishDate DATETIME,
+    ArticleText TEXT,
+    ArticleSummary TEXT NOT NULL,
+    ArticleID INTEGER
+);
+DROP TABLE IF EXISTS StagingAuthor;
+CREATE TABLE StagingAuthor (
+    StageID INTEGER NOT NULL,
+    AName VARCHAR(255) NOT NULL,
+    PRIMARY KEY (StageID, AName)
+);
+DROP TABLE IF EXISTS StagingKeyWord;
+CREATE TABLE StagingKeyWord (
+    StageID INTEGER NOT NULL,
+    KeyWord VARCHAR(255) COLLATE utf8mb4_bin NOT NULL,
+    PRIMARY KEY (StageID, KeyWord)
+);
+-- Version of this schema, databases created from an older one are upgraded by backend/migrate.py
+DROP TABLE IF EXISTS SchemaVersion;
+CREATE TABLE SchemaVersion (
+    Version INTEGER NOT NULL PRIMARY KEY,
+    Description TEXT NOT NULL,
+    AppliedAt DATETIME NOT NULL
+);
+INSERT INTO SchemaVersion VALUES (1, 'lookup indexes and VARCHAR lookup names', NOW());
 DELIMITER //
 DROP PROCEDURE IF EXISTS AddArticle;
 //
 CREATE PROCEDURE AddArticle(IN AName TEXT, IN URL TEXT, IN pubDate DATETIME, IN SourceID INTEGER, IN AText TEXT, IN Summary TEXT)
 	BEGIN
-		DECLARE maxID INT;
-        SELECT (CASE WHEN max(ArticleID) is NULL THEN 1 ELSE max(ArticleID) END) as max FROM Articles INTO maxID;
-        INSERT INTO Articles VALUES (maxID + 1, AName, URL, pubDate, SourceID, AText, Summary);
+        INSERT INTO Articles (AName, URL, PublishDate, NewsSourceID, ArticleText, ArticleSummary)
+            VALUES (AName, URL, pubDate, SourceID, AText, Summary);
     END
     //
 DELIMITER //
@@ -84,28 +122,64 @@ DROP PROCEDURE IF EXISTS AddNewAuthor;
 //
 CREATE PROCEDURE AddNewAuthor(IN AName Text)
 	BEGIN
-		DECLARE maxID INT;
-        SELECT (CASE WHEN max(AuthorID) is NULL THEN 1 ELSE max(AuthorID) END) as max FROM Author INTO maxID;
-		INSERT INTO Author VALUES(maxID + 1, AName);
+		INSERT INTO Author (AName) VALUES(AName);
 	END
     //
 DELIMITER //
 DROP PROCEDURE IF EXISTS AssignKeyWord;
 //
-CREATE PROCEDURE AssignKeyWord(IN ArticleID Integer, IN KeyWord TEXT)
+CREATE PROCEDURE AssignKeyWord(IN NewArticleID Integer, IN Word TEXT)
+	BEGIN
+        INSERT INTO KeyWord (KeyWord)
+            SELECT Word FROM DUAL WHERE NOT EXISTS (SELECT 1 FROM KeyWord K WHERE K.KeyWord = Word);
+        INSERT INTO HasKeyWord (KeyWordID, ArticleID)
+            SELECT MIN(K.KeyWordID), NewArticleID FROM KeyWord K WHERE K.KeyWord = Word
+            ON DUPLICATE KEY UPDATE HasKeyWord.ArticleID = HasKeyWord.ArticleID;
+	END
+    //
+DELIMITER //
+DROP PROCEDURE IF EXISTS MergeStagedStories;
+//
+-- Same merge as merge_staged in backend/staging.py
+CREATE PROCEDURE MergeStagedStories()
 	BEGIN
-		DECLARE maxID INT;
-        DECLARE keywordID INT;
-        IF ((SELECT KeyWordID FROM KeyWord WHERE KeyWord.KeyWord = KeyWord) IS NOT NULL) THEN
-			SELECT KeyWordID FROM KeyWord WHERE KeyWord.KeyWord = KeyWord INTO keywordID;
-			IF ((SELECT KeyWordID FROM HasKeyWord WHERE HasKeyWord.ArticleID = ArticleID) != keywordID) THEN
-				INSERT INTO HasKeyWord VALUES(keywordID, ArticleID);
-			END IF;
-        ELSE
-			SELECT (CASE WHEN max(KeyWordID) is NULL THEN 1 ELSE max(KeyWordID) END) as MAX FROM KeyWord INTO maxID;
-			INSERT INTO KeyWord VALUES(maxID + 1,  KeyWord);
-            INSERT INTO HasKeyWord VALUES(maxID + 1, ArticleID);
-        END IF;
+		INSERT INTO NewsSource (NewsSourceName, Homepage, BiasID)
+			SELECT S.NewsSourceName, MIN(S.Homepage), MIN(S.BiasID) FROM StagingArticle S
+			WHERE NOT EXISTS (SELECT 1 FROM NewsSource N WHERE N.NewsSourceName = S.NewsSourceName)
+			GROUP BY S.NewsSourceName;
+		INSERT INTO Author (AName)
+			SELECT DISTINCT S.AName FROM StagingAuthor S
+			WHERE NOT EXISTS (SELECT 1 FROM Author A WHERE A.AName = S.AName);
+		INSERT INTO KeyWord (KeyWord)
+			SELECT DISTINCT S.KeyWord FROM StagingKeyWord S
+			WHERE NOT EXISTS (SELECT 1 FROM KeyWord K WHERE K.KeyWord = S.KeyWord);
+		INSERT INTO Articles (AName, URL, PublishDate, NewsSourceID, ArticleText, ArticleSummary)
+			SELECT S.Title, S.URL, S.PublishDate, N.NewsSourceID, S.ArticleText, S.ArticleSummary
+			FROM StagingArticle S
+			JOIN (SELECT NewsSourceName, MIN(NewsSourceID) AS NewsSourceID FROM NewsSource GROUP BY NewsSourceName) N
+				ON N.NewsSourceName = S.NewsSourceName
+			WHERE S.StageID IN (SELECT MIN(StageID) FROM StagingArticle GROUP BY NewsSourceName, Title)
+				AND NOT EXISTS (SELECT 1 FROM Articles A
+					WHERE (A.NewsSourceID = N.NewsSourceID AND A.AName = S.Title) OR A.URL = S.URL)
+			ORDER BY S.StageID;
+		UPDATE StagingArticle S SET ArticleID = (
+			SELECT MIN(A.ArticleID) FROM Articles A JOIN NewsSource N ON N.NewsSourceID = A.NewsSourceID
+			WHERE N.NewsSourceName = S.NewsSourceName AND A.AName = S.Title);
+		INSERT INTO WroteBy (ArticleID, AuthorID)
+			SELECT DISTINCT S.ArticleID, A.AuthorID FROM StagingAuthor SA
+			JOIN StagingArticle S ON S.StageID = SA.StageID
+			JOIN (SELECT AName, MIN(AuthorID) AS AuthorID FROM Author GROUP BY AName) A ON A.AName = SA.AName
+			WHERE S.ArticleID IS NOT NULL
+				AND NOT EXISTS (SELECT 1 FROM WroteBy W WHERE W.ArticleID = S.ArticleID AND W.AuthorID = A.AuthorID);
+		INSERT INTO HasKeyWord (KeyWordID, ArticleID)
+			SELECT DISTINCT K.KeyWordID, S.ArticleID FROM StagingKeyWord SK
+			JOIN StagingArticle S ON S.StageID = SK.StageID
+			JOIN (SELECT KeyWord, MIN(KeyWordID) AS KeyWordID FROM KeyWord GROUP BY KeyWord) K ON K.KeyWord = SK.KeyWord
+			WHERE S.ArticleID IS NOT NULL
+				AND NOT EXISTS (SELECT 1 FROM HasKeyWord H WHERE H.ArticleID = S.ArticleID AND H.KeyWordID = K.KeyWordID);
+		DELETE FROM StagingKeyWord;
+		DELETE FROM StagingAuthor;
+		DELETE FROM StagingArticle;
 	END
     //
 
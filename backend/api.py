@@ -1,19 +1,37 @@
+import asyncio
+import heapq
 import os
 import pickle
+import weakref
 from argparse import ArgumentParser
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from threading import Lock
 from typing import List
 
+import numpy as np
 import pytz
 import uvicorn
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from sqlalchemy import desc, asc, nullslast
+from sqlalchemy import bindparam, desc, asc, nullslast
+from sqlalchemy.sql.expression import Select
 from sqlitedict import SqliteDict
 from consts import *
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from custom_types import Story
+from doc_filters import DocMetadata, DocumentFilters
+from doc_matrix import DocumentMatrix, build_document_matrix
+from doc_store import DocumentStore
+from field_index import FieldIndex, build_field_index, search_bm25f
+from index import InvertedIndex, build_inverted_index, search_max_score
+from query_cache import QueryCache
+from rw_lock import ReadWriteLock
+from segments import SegmentedIndex, build_segments
 from utils import *
 
 app = FastAPI()
@@ -33,13 +51,67 @@ if not os.path.exists(db_path):
 query_db_path = os.path.join(db_path, "queries.db")
 # query map is a map of queries to vectors
 query_map_path = os.path.join(db_path, "query_map.db")
-doc_vecs_db_path = os.path.join(db_path, "doc_vecs.db")
+# bookkeeping about the document index, e.g. its generation
+index_meta_path = os.path.join(db_path, "index_meta.db")
+# field-weighted term frequencies before idf, the document store; idf is applied when scoring
+doc_tfs_db_path = os.path.join(db_path, "doc_tfs.db")
+# analyzed tokens of the articles added since setup_db wrote the snapshots below, in store order
+index_log_db_path = os.path.join(db_path, "index_log.db")
+# analyzed title and summary tokens per ArticleID, reused across rebuilds while the content is unchanged
+article_tokens_db_path = os.path.join(db_path, "article_tokens.db")
+# Snapshots written by setup_db. Articles added later are appended to them in memory when they
+# are loaded and by refresh_indexes, they are never rebuilt for new articles.
+# term -> postings index over doc_tfs.db
+inverted_index_path = os.path.join(db_path, "inverted_index.pickle")
+# CSR matrix of doc_tfs.db with interned term ids
+doc_matrix_path = os.path.join(db_path, "doc_matrix.npz")
+# per-field postings and field lengths for BM25F
+field_index_path = os.path.join(db_path, "field_index.pickle")
+# publish date, news source, bias and authors per ArticleID, for evaluating query conditions
+doc_meta_db_path = os.path.join(db_path, "doc_meta.db")
+# condition bitmaps over doc_tfs.db in store order
+doc_filters_path = os.path.join(db_path, "doc_filters.pickle")
+# inverted index per month of publication
+segments_path = os.path.join(db_path, "segments.pickle")
+# bump whenever the files above change format, older ones have to be rebuilt with --reset_db
+INDEX_FORMAT = 2
 
 
 engine = create_engine("mysql+pymysql://db_final:password@" + AWS_IP + "/db_final_db")
 session_factory = sessionmaker(bind = engine)
 Session = scoped_session(session_factory)
 
+# resident copy of doc_tfs.db shared by all request handlers
+document_store: Optional[DocumentStore] = None
+# document frequencies of the index, idf is applied with them at query time
+doc_freqs: Optional[DocFreqs] = None
+inverted_index: Optional[InvertedIndex] = None
+document_matrix: Optional[DocumentMatrix] = None
+field_index: Optional[FieldIndex] = None
+document_filters: Optional[DocumentFilters] = None
+segmented_index: Optional[SegmentedIndex] = None
+# position of every field index document in document_filters
+field_index_ordinals: Optional[np.ndarray] = None
+# bounded cache over queries.db and query_map.db, see --cache_size
+query_cache: Optional[QueryCache] = None
+query_cache_size = 10000
+# get_articles_by_id statements by condition shape
+articles_statements: dict[tuple, Select] = {}
+max_articles_statements = 256
+# similarity used by /query, either cosine_sim (dict path) or the document matrix
+search_sim = cosine_sim
+# threads running the blocking part of /query and /query/update, see --search_workers
+search_executor: Optional[ThreadPoolExecutor] = None
+search_workers = 4
+# relevance feedback reads, updates and writes back a query vector, one lock per query string
+# in use; an entry goes away with the last thread holding or waiting for its lock
+query_update_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+query_update_locks_lock = Lock()
+# searches read the in-memory indexes while refresh_indexes appends to them
+index_lock = ReadWriteLock()
+# one index update at a time, a second one would fetch the same articles
+index_update_lock = Lock()
+
 
 def remove_repeat_articles(articles: list[Story]) -> list[Story]:
     new_article_info = set()
@@ -51,55 +123,435 @@ def remove_repeat_articles(articles: list[Story]) -> list[Story]:
     return new_articles
 
 
-def setup_db() -> None:
-    doc_vecs_db = SqliteDict(doc_vecs_db_path)
-    session = Session()
-    articles = session.execute(
-        select(Article)
-    )
-    article_weights = ArticleDataWeights(author=5, keywords=3, summary=1, title=4, publisher=5)
-    article_data = []
+def stream_rows(session, stmt, chunk_size: int):
+    # server-side cursor, rows are buffered chunk_size at a time
+    return session.execute(stmt.execution_options(stream_results=True)).yield_per(chunk_size)
+
+
+def fetch_articles(session, chunk_size: int = 1000,
+                   after_id: int = 0) -> tuple[list[int], list[RawArticle], list[DocMetadata]]:
+    """
+        Exports every article with an ArticleID above after_id, with its authors, keywords and
+        news source, in three set-based queries instead of three round trips per article.
+        """
+    authors = defaultdict(list)
+    for row in stream_rows(session,
+                           select(WroteBy.ArticleID, Author.AName)
+                           .join(Author, Author.AuthorID == WroteBy.AuthorID)
+                           .where(WroteBy.ArticleID > after_id),
+                           chunk_size):
+        authors[row.ArticleID].append(row.AName)
+    keywords = defaultdict(list)
+    for row in stream_rows(session,
+                           select(HasKeyWord.ArticleID, KeyWord.KeyWord)
+                           .join(KeyWord, KeyWord.KeyWordID == HasKeyWord.KeyWordID)
+                           .where(HasKeyWord.ArticleID > after_id),
+                           chunk_size):
+        keywords[row.ArticleID].append(row.KeyWord)
     article_ids = []
+    articles = []
+    metadata = []
+    for row in stream_rows(session,
+                           select(Article.ArticleID, Article.Aname, Article.ArticleSummary,
+                                  Article.PublishDate, NewsSource.NewsSourceName, NewsSource.BiasID)
+                           .outerjoin(NewsSource, NewsSource.NewsSourceID == Article.NewsSourceID)
+                           .where(Article.ArticleID > after_id)
+                           .order_by(Article.ArticleID),
+                           chunk_size):
+        article_ids.append(row.ArticleID)
+        articles.append(RawArticle(
+            title=row.Aname,
+            summary=row.ArticleSummary,
+            keywords=keywords[row.ArticleID],
+            author=authors[row.ArticleID],
+            publisher=[row.NewsSourceName] if row.NewsSourceName is not None else []
+        ))
+        metadata.append(DocMetadata(
+            publish_date=row.PublishDate,
+            publisher=row.NewsSourceName,
+            bias_id=row.BiasID,
+            authors=authors[row.ArticleID]
+        ))
+    return article_ids, articles, metadata
+
+
+def setup_db(chunk_size: int = 1000, n_workers: int = 1) -> None:
+    session = Session()
+    article_weights = default_article_weights
     print("Fetching articles.")
-    for article in articles.scalars():
-        author_result = session.execute(
-            select(Author.AName)
-            .join(WroteBy)
-            .where(WroteBy.ArticleID == article.ArticleID)
-        )
-        authors = [author for author in author_result.scalars()]
-        keyword_result = session.execute(
-            select(KeyWord.KeyWord)
-            .join(HasKeyWord)
-            .where(HasKeyWord.ArticleID == article.ArticleID)
-        )
-        keywords = [keyword for keyword in keyword_result.scalars()]
-        news_source: NewsSource = session.execute(
-            select(NewsSource)
-            .where(NewsSource.NewsSourceID == article.NewsSourceID)
-        ).first()
-        new_data = ArticleData(
-            title=tokenize_string(article.Aname),
-            summary=tokenize_string(article.ArticleSummary),
-            keywords=keywords,
-            author=authors,
-            publisher=[news_source.NewsSource.NewsSourceName]
-        )
-        article_data.append(new_data)
-        article_ids.append(article.ArticleID)
+    article_ids, articles, metadata = fetch_articles(session, chunk_size)
+    Session.remove()
     print("Articles fetched.")
-
-    vectors = generate_doc_tfidfs(article_data, article_weights)
-    print("Document vectors created.")
+    store_doc_metadata(article_ids, metadata)
+
+    articles = load_cached_tokens(article_ids, articles)
+    article_data, doc_freqs, tfs = analyze_articles(articles, article_weights, n_workers)
+    store_cached_tokens(article_ids, articles, article_data)
+    doc_ids = [str(id) for id in article_ids]
+    build_field_index(doc_ids, article_data).save(field_index_path)
+    # the snapshots follow the store order, so it is rewritten in fetch order
+    clear_db(doc_tfs_db_path)
+    doc_tfs_db = SqliteDict(doc_tfs_db_path)
     for i, id in enumerate(article_ids):
-        # store associated document vector in K,V store
-        doc_vecs_db[id] = vectors[i]
-    Session.remove()
-    doc_vecs_db.commit()
-    doc_vecs_db.close()
+        doc_tfs_db[id] = tfs[i]
+    doc_tfs_db.commit()
+    doc_tfs_db.close()
+    write_index_snapshots(doc_ids, tfs, metadata)
+    clear_db(index_log_db_path)
+    save_index_state(doc_freqs, max(article_ids, default=0))
+    bump_index_generation()
     print("Finished setting up vector db")
 
 
+def update_db(chunk_size: int = 1000, n_workers: int = 1) -> None:
+    """
+        Adds the articles with an ArticleID above the stored high-water mark to the document
+        store. Nothing already indexed is fetched, tokenized or re-weighted; the indexes append
+        the new articles when they are loaded, or through /index/update in a running server.
+        """
+    _, high_water_mark = load_index_state()
+    if high_water_mark is None or not os.path.exists(field_index_path):
+        print("No index to update, building it from scratch.")
+        setup_db(chunk_size, n_workers)
+        return
+    added = ingest_new_articles(chunk_size, n_workers)
+    print("Finished updating vector db, {} new articles.".format(added))
+
+
+def ingest_new_articles(chunk_size: int = 1000, n_workers: int = 1) -> int:
+    """
+        Appends the term frequencies, metadata and tokens of every article above the high-water
+        mark to the stores, and merges their document frequencies into the index state.
+        Returns the number of articles added.
+        """
+    doc_freqs, high_water_mark = load_index_state()
+    session = Session()
+    print("Fetching articles after ArticleID {}.".format(high_water_mark))
+    article_ids, articles, metadata = fetch_articles(session, chunk_size, after_id=high_water_mark)
+    Session.remove()
+    if len(article_ids) == 0:
+        return 0
+    print("{} new articles fetched.".format(len(article_ids)))
+    store_doc_metadata(article_ids, metadata)
+
+    articles = load_cached_tokens(article_ids, articles)
+    article_data, new_doc_freqs, new_tfs = analyze_articles(articles, default_article_weights, n_workers)
+    store_cached_tokens(article_ids, articles, article_data)
+    doc_tfs_db = SqliteDict(doc_tfs_db_path)
+    index_log = SqliteDict(index_log_db_path)
+    for i, id in enumerate(article_ids):
+        doc_tfs_db[id] = new_tfs[i]
+        index_log[id] = article_data[i]
+    doc_tfs_db.commit()
+    doc_tfs_db.close()
+    index_log.commit()
+    index_log.close()
+    # written last, until then the next update fetches the same articles again
+    save_index_state(doc_freqs.merge(new_doc_freqs), max(high_water_mark, max(article_ids)))
+    bump_index_generation()
+    return len(article_ids)
+
+
+def load_cached_tokens(article_ids: list[int],
+                       articles: list[RawArticle]) -> list[Union[RawArticle, ArticleData]]:
+    """
+        Replaces every article whose tokens are cached for its current content with its
+        ArticleData, so only new or changed articles are tokenized.
+        """
+    article_tokens_db = SqliteDict(article_tokens_db_path)
+    results = []
+    for id, article in zip(article_ids, articles):
+        cached = article_tokens_db.get(id)
+        if cached is not None and cached.content_hash == article_content_hash(article):
+            results.append(ArticleData(
+                title=cached.title,
+                summary=cached.summary,
+                author=article.author,
+                publisher=article.publisher,
+                keywords=article.keywords
+            ))
+        else:
+            results.append(article)
+    article_tokens_db.close()
+    print("{} of {} articles need tokenizing.".format(
+        sum(isinstance(article, RawArticle) for article in results), len(results)))
+    return results
+
+
+def store_cached_tokens(article_ids: list[int], articles: list[Union[RawArticle, ArticleData]],
+                        article_data: list[ArticleData]) -> None:
+    article_tokens_db = SqliteDict(article_tokens_db_path)
+    for id, article, data in zip(article_ids, articles, article_data):
+        # only articles that were tokenized this time are missing from the cache
+        if isinstance(article, RawArticle):
+            article_tokens_db[id] = ArticleTokens(article_content_hash(article), data.title, data.summary)
+    article_tokens_db.commit()
+    article_tokens_db.close()
+
+
+def store_doc_metadata(article_ids: list[int], metadata: list[DocMetadata]) -> None:
+    doc_meta_db = SqliteDict(doc_meta_db_path)
+    for id, meta in zip(article_ids, metadata):
+        doc_meta_db[id] = meta
+    doc_meta_db.commit()
+    doc_meta_db.close()
+
+
+def load_doc_metadata(doc_ids: list) -> list[Optional[DocMetadata]]:
+    doc_meta_db = SqliteDict(doc_meta_db_path)
+    metadata = [doc_meta_db.get(id) for id in doc_ids]
+    doc_meta_db.close()
+    missing = sum(meta is None for meta in metadata)
+    if missing > 0:
+        print("{} documents have no metadata and never match query conditions, run with --reset_db".format(missing))
+    return metadata
+
+
+def write_index_snapshots(doc_ids: list, tfs: list[BagOfWordsVector], metadata: list[DocMetadata]) -> None:
+    # doc_ids in store order, so postings, rows and bitmaps follow it
+    build_inverted_index(zip(doc_ids, tfs)).save(inverted_index_path)
+    build_document_matrix(zip(doc_ids, tfs)).save(doc_matrix_path)
+    DocumentFilters(doc_ids, metadata).save(doc_filters_path)
+    build_segments(zip(doc_ids, tfs, [meta.publish_date for meta in metadata])).save(segments_path)
+    print("Document index written.")
+
+
+def save_index_state(doc_freqs: DocFreqs, high_water_mark: int) -> None:
+    index_meta = SqliteDict(index_meta_path)
+    # DocFreqs does not pickle its document count, store the counts separately
+    index_meta["doc_freqs"] = dict(doc_freqs)
+    index_meta["num_docs"] = doc_freqs.get_num_docs()
+    index_meta["high_water_mark"] = high_water_mark
+    index_meta["index_format"] = INDEX_FORMAT
+    index_meta.commit()
+    index_meta.close()
+
+
+def load_index_state() -> tuple[DocFreqs, Optional[int]]:
+    index_meta = SqliteDict(index_meta_path)
+    doc_freqs = DocFreqs(index_meta.get("doc_freqs", {}), index_meta.get("num_docs", 0))
+    high_water_mark = index_meta.get("high_water_mark")
+    index_meta.close()
+    return doc_freqs, high_water_mark
+
+
+def check_index_format(require_built: bool = True) -> None:
+    index_meta = SqliteDict(index_meta_path)
+    built = "high_water_mark" in index_meta
+    index_format = index_meta.get("index_format")
+    index_meta.close()
+    if built and index_format != INDEX_FORMAT:
+        raise SystemExit("The document index was built by an older version, rebuild it with --reset_db")
+    if not built and require_built:
+        # installs from before index_meta.db only have doc_vecs.db, which nothing reads any more
+        raise SystemExit("No document index to serve, build it with --reset_db")
+
+
+def get_index_generation() -> int:
+    index_meta = SqliteDict(index_meta_path)
+    generation = index_meta.get("generation", 0)
+    index_meta.close()
+    return generation
+
+
+def bump_index_generation() -> int:
+    # cached results from earlier generations are dropped on their next read
+    index_meta = SqliteDict(index_meta_path)
+    generation = index_meta.get("generation", 0) + 1
+    index_meta["generation"] = generation
+    index_meta.commit()
+    index_meta.close()
+    return generation
+
+
+def load_doc_freqs() -> DocFreqs:
+    global doc_freqs
+    if doc_freqs is None:
+        doc_freqs, _ = load_index_state()
+    return doc_freqs
+
+
+def load_document_store() -> DocumentStore:
+    global document_store
+    if document_store is None:
+        document_store = DocumentStore.load(doc_tfs_db_path, load_doc_freqs())
+    return document_store
+
+
+def documents_after(count: int) -> list:
+    # documents of the store that an index holding its first count documents is missing
+    return list(islice(load_document_store(), count, None))
+
+
+def catch_up_inverted_index(index: InvertedIndex) -> None:
+    store = load_document_store()
+    for doc_id in documents_after(len(index)):
+        index.add_document(doc_id, store.tf(doc_id))
+
+
+def catch_up_document_matrix(matrix: DocumentMatrix) -> None:
+    store = load_document_store()
+    matrix.append((doc_id, store.tf(doc_id)) for doc_id in documents_after(len(matrix)))
+
+
+def catch_up_field_index(index: FieldIndex) -> None:
+    doc_ids = documents_after(len(index))
+    if len(doc_ids) == 0:
+        return
+    index_log = SqliteDict(index_log_db_path)
+    for doc_id in doc_ids:
+        index.add_document(doc_id, index_log[doc_id])
+    index_log.close()
+
+
+def catch_up_document_filters(filters: DocumentFilters) -> None:
+    doc_ids = documents_after(len(filters))
+    if len(doc_ids) > 0:
+        filters.append(doc_ids, load_doc_metadata(doc_ids))
+
+
+def catch_up_segmented_index(segments: SegmentedIndex) -> None:
+    store = load_document_store()
+    doc_ids = documents_after(segments.num_docs())
+    if len(doc_ids) > 0:
+        metadata = load_doc_metadata(doc_ids)
+        segments.append((doc_id, store.tf(doc_id), meta.publish_date if meta is not None else None)
+                        for doc_id, meta in zip(doc_ids, metadata))
+
+
+def load_inverted_index() -> Optional[InvertedIndex]:
+    global inverted_index
+    if inverted_index is None and os.path.exists(inverted_index_path):
+        index = InvertedIndex.load(inverted_index_path)
+        index.set_doc_freqs(load_doc_freqs())
+        catch_up_inverted_index(index)
+        inverted_index = index
+    return inverted_index
+
+
+def load_document_matrix() -> Optional[DocumentMatrix]:
+    global document_matrix
+    if document_matrix is None and os.path.exists(doc_matrix_path):
+        matrix = DocumentMatrix.load(doc_matrix_path)
+        matrix.set_doc_freqs(load_doc_freqs())
+        catch_up_document_matrix(matrix)
+        document_matrix = matrix
+    return document_matrix
+
+
+def load_field_index() -> Optional[FieldIndex]:
+    global field_index
+    if field_index is None and os.path.exists(field_index_path):
+        index = FieldIndex.load(field_index_path)
+        catch_up_field_index(index)
+        field_index = index
+    return field_index
+
+
+def load_document_filters() -> Optional[DocumentFilters]:
+    global document_filters
+    if document_filters is None and os.path.exists(doc_filters_path):
+        filters = DocumentFilters.load(doc_filters_path)
+        catch_up_document_filters(filters)
+        document_filters = filters
+    return document_filters
+
+
+def load_segmented_index() -> Optional[SegmentedIndex]:
+    global segmented_index
+    if segmented_index is None and os.path.exists(segments_path):
+        segments = SegmentedIndex.load(segments_path)
+        segments.set_doc_freqs(load_doc_freqs())
+        catch_up_segmented_index(segments)
+        segmented_index = segments
+    return segmented_index
+
+
+def refresh_indexes() -> int:
+    """
+        Picks up the articles added to the stores since they were loaded, by /index/update or a
+        run of --update_db: they are appended to the document store and to every loaded index,
+        and the new document frequencies replace the old ones. Searches hold the read side of
+        index_lock, so none of them sees a half-appended index.
+        Returns the number of documents appended.
+        """
+    global doc_freqs
+    with index_lock.writing():
+        store = load_document_store()
+        count = len(store)
+        doc_tfs_db = SqliteDict(doc_tfs_db_path)
+        index_log = SqliteDict(index_log_db_path)
+        # the log lists every article added since the snapshots, in store order
+        for doc_id in index_log.keys():
+            if doc_id not in store:
+                store.add(doc_id, doc_tfs_db[doc_id])
+        doc_tfs_db.close()
+        index_log.close()
+        doc_freqs, _ = load_index_state()
+        store.set_doc_freqs(doc_freqs)
+        for index, catch_up in ((inverted_index, catch_up_inverted_index),
+                                (document_matrix, catch_up_document_matrix),
+                                (field_index, catch_up_field_index),
+                                (document_filters, catch_up_document_filters),
+                                (segmented_index, catch_up_segmented_index)):
+            if index is not None:
+                catch_up(index)
+        for index in (inverted_index, document_matrix, segmented_index):
+            if index is not None:
+                index.set_doc_freqs(doc_freqs)
+        load_query_cache().set_generation(get_index_generation())
+        return len(store) - count
+
+
+def load_query_cache() -> QueryCache:
+    global query_cache
+    if query_cache is None:
+        query_cache = QueryCache(query_db_path, query_map_path, get_index_generation(), query_cache_size)
+    return query_cache
+
+
+def load_search_executor() -> ThreadPoolExecutor:
+    global search_executor
+    if search_executor is None:
+        search_executor = ThreadPoolExecutor(max_workers=search_workers, thread_name_prefix="search")
+    return search_executor
+
+
+def read_index(function, *args, **kwargs):
+    # searches hold the index read lock, refresh_indexes never appends under them
+    with index_lock.reading():
+        return function(*args, **kwargs)
+
+
+async def run_in_search_pool(function, *args, **kwargs):
+    """
+        Runs a blocking function (scoring, SqliteDict and SQLAlchemy calls) on the search threads
+        so the event loop keeps serving other requests while it runs
+        """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(load_search_executor(), partial(function, *args, **kwargs))
+
+
+@app.on_event("startup")
+def load_indexes() -> None:
+    load_search_executor()
+    load_query_cache()
+    load_document_store()
+    load_inverted_index()
+    load_document_matrix()
+    load_field_index()
+    load_document_filters()
+    load_segmented_index()
+
+
+@app.on_event("shutdown")
+def shutdown_search_executor() -> None:
+    global search_executor
+    if search_executor is not None:
+        search_executor.shutdown(wait=True)
+        search_executor = None
+
+
 def clear_db(db_path_shadow: str) -> None:
     doc_vecs_db = SqliteDict(db_path_shadow)
     print("Clearing db {}".format(db_path_shadow))
@@ -115,18 +567,36 @@ def add_conditions(stmt, condition_list: List[QueryCondition]):
     return stmt
 
 
+def compile_articles_statement(condition_tree: List[QueryCondition]) -> tuple:
+    """
+        One parameterized statement for the articles in :ids that satisfy every condition, and its
+        bind values. Statements are cached by the shape of the condition tree, so a repeated
+        shape only binds new values and SQLAlchemy reuses its compiled form.
+        """
+    keys = ["condition_{}".format(position) for position in range(len(condition_tree))]
+    params = {}
+    for key, condition in zip(keys, condition_tree):
+        params.update(condition.bind_values(key))
+    shape = tuple(condition.shape() for condition in condition_tree)
+    stmt = articles_statements.get(shape)
+    if stmt is None:
+        stmt = select(Article, NewsSource)\
+            .join(NewsSource, NewsSource.NewsSourceID == Article.NewsSourceID)\
+            .where(Article.ArticleID.in_(bindparam("ids", expanding=True)))
+        for key, condition in zip(keys, condition_tree):
+            clause = condition.clause(key)
+            if clause is not None:
+                stmt = stmt.where(clause)
+        stmt = stmt.order_by(desc(Article.PublishDate))
+        if len(articles_statements) < max_articles_statements:
+            articles_statements[shape] = stmt
+    return stmt, params
+
+
 def get_articles_by_id(ids: List[int], condition_tree) -> List[dict]:
     session = Session()
-    output = []
-    #j = join(Article, NewsSource, Article.NewsSourceID == NewsSource.NewsSourceID)
-    stmt = select(Article, NewsSource)\
-        .where(Article.NewsSourceID == NewsSource.NewsSourceID)\
-        .where(Article.ArticleID.in_(ids))
-    stmt = add_conditions(stmt, condition_tree)
-    stmt = stmt.order_by(desc(Article.PublishDate))
-    articles_and_sources = session.execute(
-        stmt
-    )
+    stmt, params = compile_articles_statement(condition_tree)
+    articles_and_sources = session.execute(stmt, dict(params, ids=list(ids)))
     results = []
     for row in articles_and_sources:
         doc_dict = {
@@ -146,9 +616,42 @@ def get_articles_by_id(ids: List[int], condition_tree) -> List[dict]:
 
 
 @app.get("/query")
-async def get_articles(q: str, n_results: Optional[int] = 20) -> dict:
-    # first see if we have a cached result
+async def get_articles(q: str, n_results: Optional[int] = 20,
+                       ranking: str = "tfidf",
+                       title_weight: Optional[float] = None,
+                       summary_weight: Optional[float] = None,
+                       author_weight: Optional[float] = None,
+                       publisher_weight: Optional[float] = None,
+                       keywords_weight: Optional[float] = None) -> dict:
+    return await run_in_search_pool(read_index, search_articles, q, n_results, ranking, title_weight,
+                                    summary_weight, author_weight, publisher_weight, keywords_weight)
+
+
+def search_articles(q: str, n_results: Optional[int] = 20,
+                    ranking: str = "tfidf",
+                    title_weight: Optional[float] = None,
+                    summary_weight: Optional[float] = None,
+                    author_weight: Optional[float] = None,
+                    publisher_weight: Optional[float] = None,
+                    keywords_weight: Optional[float] = None) -> dict:
     query_string, condition_tree = extract_query_conditions(q)
+    allowed = get_condition_candidates(condition_tree)
+    if ranking == "bm25f":
+        # field weights may differ per request, so BM25F rankings are not cached
+        weights = get_field_weights(title=title_weight, summary=summary_weight, author=author_weight,
+                                    publisher=publisher_weight, keywords=keywords_weight)
+        result_ids = get_bm25f_results(process_query(query_string), n_results, weights, allowed)
+        results = get_articles_by_id(result_ids, condition_tree)
+        return {"results": results}
+    elif ranking != "tfidf":
+        raise HTTPException(status_code=400, detail="ranking must be tfidf or bm25f")
+    if allowed is not None:
+        # cached rankings were computed over every document, rank only the matching ones
+        result_ids = get_nearest(process_query(query_string), k=n_results, sim=search_sim, allowed=allowed,
+                                 date_range=get_date_bounds(condition_tree))
+        results = get_articles_by_id(result_ids, condition_tree)
+        return {"results": results}
+    # first see if we have a cached result
     result_ids, processed_query = check_for_cached_result(query_string)
     if len(result_ids) > 0:
         results = get_articles_by_id(result_ids, condition_tree)
@@ -159,18 +662,59 @@ async def get_articles(q: str, n_results: Optional[int] = 20) -> dict:
         return {"results": results}
 
 
+def get_field_weights(**overrides: Optional[float]) -> ArticleDataWeights:
+    return default_article_weights._replace(
+        **{field: weight for field, weight in overrides.items() if weight is not None}
+    )
+
+
+def get_bm25f_results(processed_query: BagOfWordsVector, k: int,
+                      weights: ArticleDataWeights = default_article_weights,
+                      allowed: Optional[np.ndarray] = None) -> list:
+    global field_index_ordinals
+    index = load_field_index()
+    if index is None:
+        raise HTTPException(status_code=503, detail="No field index, run with --reset_db")
+    if allowed is not None:
+        # the field index is not guaranteed to list documents in store order
+        known = 0 if field_index_ordinals is None else len(field_index_ordinals)
+        if known != len(index):
+            new_ordinals = load_document_filters().ordinals_of(index.doc_ids[known:])
+            field_index_ordinals = new_ordinals if known == 0 \
+                else np.concatenate((field_index_ordinals, new_ordinals))
+        allowed = np.where(field_index_ordinals >= 0, allowed[field_index_ordinals], False)
+    return search_bm25f(processed_query, index, k, weights, allowed)
+
+
+def get_condition_candidates(condition_tree: List[QueryCondition]) -> Optional[np.ndarray]:
+    """
+        Mask over the document store of the documents satisfying every condition, so they can be
+        ranked before the top k is cut instead of filtered afterwards. None without conditions or
+        without a filter index, in which case conditions only apply in get_articles_by_id.
+        """
+    filters = load_document_filters()
+    if filters is None or len(condition_tree) == 0:
+        return None
+    return filters.candidates(condition_tree)
+
+
+def get_date_bounds(condition_tree: List[QueryCondition]) -> Optional[tuple]:
+    """
+        Tightest (<after>, <before>) publish date bounds of the conditions, None if they have none
+        """
+    after = max((condition.date for condition in condition_tree if isinstance(condition, AfterCondition)),
+                default=None)
+    before = min((condition.date for condition in condition_tree if isinstance(condition, BeforeCondition)),
+                 default=None)
+    if after is None and before is None:
+        return None
+    return after, before
+
+
 # Isolate function to generate new search results in case queries need to be updated
 def get_new_search_results(q: str, processed_query: BagOfWordsVector, k: int) -> list:
-    search_results = get_nearest(processed_query, k=k)
-    query_map_db = SqliteDict(query_map_path)
-    query_map_db[q] = processed_query
-    query_map_db.commit()
-    query_map_db.close()
-
-    query_db = SqliteDict(query_db_path)
-    query_db[q] = search_results
-    query_db.commit()
-    query_db.close()
+    search_results = get_nearest(processed_query, k=k, sim=search_sim)
+    load_query_cache().put(q, processed_query, search_results)
     return search_results
 
 
@@ -187,27 +731,20 @@ def sort_search_by_date(search_results: list) -> list:
 
 # Check db to see if we've precomputed a similar query already
 def check_for_cached_result(query: str, thresh: float = 0.8, sim=cosine_sim) -> tuple:
-    query_map = SqliteDict(query_map_path)
-    query_results = SqliteDict(query_db_path)
+    cache = load_query_cache()
     # see if we have computed this exact query before
-    try:
-        result = query_results[query]
-        query_vec = query_map[query]
-        query_map.close()
-        query_results.close()
-        return result, query_vec
-    except KeyError:
-        pass
+    cached = cache.get(query)
+    if cached is not None:
+        return cached
     # If not, see if any query is close enough
     processed_query = process_query(query)
-    max_sim_query, score = get_max_sim(processed_query, query_map.items(), sim=sim)
+    # only cached queries sharing a term with this one can score above 0
+    candidates = cache.candidates(processed_query)
+    max_sim_query, score = get_max_sim(processed_query, candidates, sim=sim)
     if score > thresh:
-        result = query_results[max_sim_query]
-        query_map.close()
-        query_results.close()
-        return result, processed_query
-    query_map.close()
-    query_results.close()
+        cached = cache.get(max_sim_query)
+        if cached is not None:
+            return cached[0], processed_query
     return [], processed_query
 
 
@@ -217,7 +754,7 @@ def get_max_sim(q1: BagOfWordsVector,
     max_sim_query = ""
     max_sim_score = -1
     for query, vector in queries:
-        sim_score = sim(q1, string2vec(query))
+        sim_score = sim(q1, vector)
         if sim_score > max_sim_score:
             max_sim_score = sim_score
             max_sim_query = query
@@ -252,7 +789,41 @@ def search_by_threshold(query_vec: BagOfWordsVector, doc_pairs: list, thresh: fl
 # returns k nearest neighbor documents
 def search_by_knn(query_vec: BagOfWordsVector, doc_pairs: list, k: int, sim=cosine_sim,
                   return_all: bool = False) -> list:
-    results = sort_by_sim(query_vec, doc_pairs, sim=sim)
+    if return_all:
+        return sort_by_sim(query_vec, doc_pairs, sim=sim)
+    # bounded heap, equivalent to sorting by score and slicing [:k]
+    top_k = heapq.nlargest(k, ((doc_id, sim(query_vec, doc_vec)) for doc_id, doc_vec in doc_pairs),
+                           key=lambda item: item[1])
+    return [item[0] for item in top_k]
+
+
+def search_inverted_index(query_vec: BagOfWordsVector, index: InvertedIndex, doc_db, k: int,
+                          sim=cosine_sim, return_all: bool = False,
+                          allowed: Optional[np.ndarray] = None) -> list:
+    """
+        Ranks documents exactly as search_by_knn would, but only scores documents sharing a
+        term with the query. Every other document has a similarity of 0 and keeps its store order.
+        When allowed is given only the documents it marks are ranked.
+        """
+    scored = [(ordinal, sim(query_vec, doc_db[index.doc_ids[ordinal]]))
+              for ordinal in index.candidates(query_vec)
+              if allowed is None or allowed[ordinal]]
+    positive = (item for item in scored if item[1] > 0)
+    if return_all:
+        positive = sorted(positive, key=lambda item: item[1], reverse=True)
+    else:
+        positive = heapq.nlargest(k, positive, key=lambda item: item[1])
+    results = [index.doc_ids[ordinal] for ordinal, _ in positive]
+    if not return_all and len(results) >= k:
+        return results[:k]
+    nonzero = {ordinal for ordinal, score in scored if score != 0}
+    for ordinal in (range(len(index)) if allowed is None else np.flatnonzero(allowed)):
+        if not return_all and len(results) >= k:
+            return results
+        if ordinal not in nonzero:
+            results.append(index.doc_ids[ordinal])
+    negative = sorted((item for item in scored if item[1] < 0), key=lambda item: item[1], reverse=True)
+    results.extend(index.doc_ids[ordinal] for ordinal, _ in negative)
     return results if return_all else results[:k]
 
 
@@ -260,11 +831,33 @@ def get_nearest(query_vec: BagOfWordsVector,
                 k: int = 20,
                 thresh: int = 0,
                 sim=cosine_sim,
-                return_all: bool = False) -> list:
+                return_all: bool = False,
+                allowed: Optional[np.ndarray] = None,
+                date_range: Optional[tuple] = None) -> list:
+    segments = load_segmented_index() if date_range is not None else None
+    if segments is not None and thresh == 0 and not return_all \
+            and (isinstance(sim, DocumentMatrix) or sim is cosine_sim):
+        if allowed is None:
+            allowed = load_document_filters().date_mask(*date_range)
+        return search_segments(query_vec, segments.overlapping(*date_range), segments.ordinal_of, k,
+                               sim=sim, allowed=allowed)
+    if isinstance(sim, DocumentMatrix) and thresh == 0:
+        scores = sim.score(query_vec)
+        ordinals = np.arange(len(scores)) if allowed is None else np.flatnonzero(allowed)
+        scores = scores[ordinals]
+        order = np.argsort(-scores, kind="stable") if return_all else top_k_indices(scores, k)
+        return [sim.doc_ids[ordinals[i]] for i in order]
+    index = load_inverted_index()
+    store = load_document_store()
+    if index is not None and thresh == 0 and sim is cosine_sim:
+        results = None if return_all \
+            else search_max_score(query_vec, index, store, k, sim=sim, allowed=allowed)
+        if results is not None:
+            return results
+        return search_inverted_index(query_vec, index, store, k, sim=sim, return_all=return_all,
+                                     allowed=allowed)
     # Generate tuple list with entries in the form of (<doc_id>, <doc_vector>)
-    db = SqliteDict(doc_vecs_db_path)
-    doc_pairs = [(key, value) for key, value in db.items()]
-    db.close()
+    doc_pairs = [pair for ordinal, pair in enumerate(store.items()) if allowed is None or allowed[ordinal]]
     if thresh != 0:
         results = search_by_threshold(query_vec, doc_pairs, thresh, sim=sim)
     else:
@@ -272,6 +865,36 @@ def get_nearest(query_vec: BagOfWordsVector,
     return results
 
 
+def search_segments(query_vec: BagOfWordsVector, segments: list, ordinal_of: dict, k: int,
+                    sim=cosine_sim, allowed: Optional[np.ndarray] = None) -> list:
+    """
+        Top k over the given date segments only, ranked like get_nearest ranks the whole store
+        restricted to allowed. With the document matrix only the rows of the segments are scored;
+        otherwise every segment contributes its own top k from its inverted index and those are
+        merged by score, ties in store order.
+        """
+    if len(segments) == 0:
+        return []
+    if isinstance(sim, DocumentMatrix):
+        rows = np.sort(np.concatenate([segment.ordinals for segment in segments]))
+        if allowed is not None:
+            rows = rows[allowed[rows]]
+        order = top_k_indices(sim.score_rows(query_vec, rows), k)
+        return [sim.doc_ids[rows[i]] for i in order]
+    store = load_document_store()
+    candidates = []
+    for segment in segments:
+        local = None if allowed is None else allowed[segment.ordinals]
+        if local is not None and not local.any():
+            continue
+        results = search_max_score(query_vec, segment.index, store, k, sim=sim, allowed=local)
+        if results is None:
+            results = search_inverted_index(query_vec, segment.index, store, k, sim=sim, allowed=local)
+        candidates.extend((sim(query_vec, store[doc_id]), ordinal_of[doc_id], doc_id) for doc_id in results)
+    top_k = heapq.nsmallest(k, candidates, key=lambda item: (-item[0], item[1]))
+    return [doc_id for _, _, doc_id in top_k]
+
+
 class QueryUpdate(BaseModel):
     q: str
     undo: bool
@@ -282,9 +905,32 @@ class QueryUpdate(BaseModel):
 @app.post("/query/update")
 async def relevance_feedback(body: QueryUpdate) -> None:
     if not body.undo:
-        update_query(body.q, body.relevant, body.irrelevant)
+        await run_in_search_pool(read_index, update_query, body.q, body.relevant, body.irrelevant)
     else:
-        undo_update_query(body.q, body.relevant, body.irrelevant)
+        await run_in_search_pool(read_index, undo_update_query, body.q, body.relevant, body.irrelevant)
+
+
+class QueryUpdateLock:
+    # a plain Lock cannot be weakly referenced
+    def __init__(self):
+        self.lock = Lock()
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+def get_query_update_lock(q: str) -> QueryUpdateLock:
+    # held until the updated vector and its results are both cached, so updates of the same
+    # query cannot interleave while updates of different queries run concurrently
+    with query_update_locks_lock:
+        lock = query_update_locks.get(q)
+        if lock is None:
+            lock = query_update_locks[q] = QueryUpdateLock()
+        return lock
 
 
 def update_query(q: str,
@@ -292,11 +938,12 @@ def update_query(q: str,
                  irrelevant: list[int] = None,
                  alpha=0.9,
                  beta=0.1) -> None:
-    query_vector = try_to_get_query_from_db(q)
-    query_vector = add_docs_to_query_vector(query_vector, relevant, alpha)
-    query_vector = subtract_docs_from_query_vector(query_vector, irrelevant, beta)
-    put_query_in_map_db(q, query_vector)
-    get_new_search_results(q, query_vector, k=20)
+    with get_query_update_lock(q):
+        query_vector = try_to_get_query_from_db(q)
+        query_vector = add_docs_to_query_vector(query_vector, relevant, alpha)
+        query_vector = subtract_docs_from_query_vector(query_vector, irrelevant, beta)
+        put_query_in_map_db(q, query_vector)
+        get_new_search_results(q, query_vector, k=20)
 
 
 def undo_update_query(q: str,
@@ -304,39 +951,35 @@ def undo_update_query(q: str,
                       irrelevant: list[int] = None,
                       alpha: float = 0.9,
                       beta: float = 0.1) -> None:
-    query_vector = try_to_get_query_from_db(q)
-    query_vector = add_docs_to_query_vector(query_vector, irrelevant, alpha)
-    query_vector = subtract_docs_from_query_vector(query_vector, relevant, beta)
-    put_query_in_map_db(q, query_vector)
-    get_new_search_results(q, query_vector, k=20)
+    with get_query_update_lock(q):
+        query_vector = try_to_get_query_from_db(q)
+        query_vector = add_docs_to_query_vector(query_vector, irrelevant, alpha)
+        query_vector = subtract_docs_from_query_vector(query_vector, relevant, beta)
+        put_query_in_map_db(q, query_vector)
+        get_new_search_results(q, query_vector, k=20)
 
 
 def try_to_get_query_from_db(q: str) -> BagOfWordsVector:
-    query_map = SqliteDict(query_map_path)
-    try:
-        query_vector = query_map[q]
-        query_map.close()
-        return query_vector
-    except KeyError:
-        query_map.close()
+    query_vector = load_query_cache().get_vector(q)
+    if query_vector is None:
         raise HTTPException
+    return query_vector
 
 
 def add_docs_to_query_vector(query_vector: BagOfWordsVector,
                              docs: list[int],
                              alpha: float) -> BagOfWordsVector:
-    doc_db = SqliteDict(doc_vecs_db_path)
+    doc_db = load_document_store()
     for doc_id in docs:
         doc_vector = try_to_get_doc_vector_from_db(doc_id, doc_db)
         query_vector = add_vectors(query_vector, scalar_multiply(doc_vector, alpha))
-    doc_db.close()
     return query_vector
 
 
-def try_to_get_doc_vector_from_db(doc_id: int, doc_db: SqliteDict) -> BagOfWordsVector:
+def try_to_get_doc_vector_from_db(doc_id: int, doc_db: DocumentStore) -> BagOfWordsVector:
     vector = {}
     try:
-        vector = doc_db[doc_id].vector
+        vector = doc_db[doc_id]
     except KeyError:
         pass
     return vector
@@ -345,34 +988,78 @@ def try_to_get_doc_vector_from_db(doc_id: int, doc_db: SqliteDict) -> BagOfWords
 def subtract_docs_from_query_vector(query_vector: BagOfWordsVector,
                                     docs: list[int],
                                     beta: float) -> BagOfWordsVector:
-    doc_db = SqliteDict(doc_vecs_db_path)
+    doc_db = load_document_store()
     for doc_id in docs:
         doc_vector = try_to_get_doc_vector_from_db(doc_id, doc_db)
         query_vector = subtract_vectors(query_vector, scalar_multiply(doc_vector, beta))
-    doc_db.close()
     return query_vector
 
 
 def put_query_in_map_db(q: str, query_vector: BagOfWordsVector) -> None:
-    query_map = SqliteDict(query_map_path)
-    query_map[q] = query_vector
-    query_map.commit()
-    query_map.close()
+    load_query_cache().put_vector(q, query_vector)
+
+
+@app.post("/index/update")
+async def update_index() -> dict:
+    return await run_in_search_pool(update_and_refresh_index)
+
+
+def update_and_refresh_index() -> dict:
+    """
+        Indexes the articles loaded into MySQL since the last update without restarting the
+        server, and picks up any added by --update_db
+        """
+    with index_update_lock:
+        if load_index_state()[1] is None:
+            raise HTTPException(status_code=503, detail="No index to update, run with --reset_db")
+        ingest_new_articles()
+        added = refresh_indexes()
+    return {"added": added, "documents": len(load_document_store())}
+
+
+@app.get("/cache/stats")
+def get_cache_stats() -> dict:
+    # a plain def runs in FastAPI's threadpool, waiting for the cache lock off the event loop
+    return load_query_cache().stats()
 
 
 def main() -> None:
+    global search_sim, query_cache_size, search_workers
     parser = ArgumentParser()
     parser.add_argument("--reset_db", dest="reset_db", action="store_true")
     parser.set_defaults(reset_db=False)
+    parser.add_argument("--update_db", dest="update_db", action="store_true",
+                        help="index only articles added since the last build")
+    parser.set_defaults(update_db=False)
     parser.add_argument("--reset_cache", dest="reset_cache", action="store_true")
     parser.set_defaults(reset_cache=False)
+    parser.add_argument("--scorer", choices=["dict", "matrix"], default="dict")
+    parser.add_argument("--fetch_chunk_size", type=int, default=1000,
+                        help="rows buffered per round trip when exporting articles")
+    parser.add_argument("--n_workers", type=int, default=1,
+                        help="processes used to tokenize and count terms when indexing")
+    parser.add_argument("--cache_size", type=int, default=query_cache_size,
+                        help="maximum number of cached queries")
+    parser.add_argument("--search_workers", type=int, default=search_workers,
+                        help="threads scoring queries and reading the databases concurrently")
     args = parser.parse_args()
+    query_cache_size = args.cache_size
+    search_workers = args.search_workers
     if args.reset_db:
-        clear_db(doc_vecs_db_path)
-        setup_db()
+        clear_db(doc_meta_db_path)
+        setup_db(args.fetch_chunk_size, args.n_workers)
+    else:
+        # --update_db builds a missing index from scratch
+        check_index_format(require_built=not args.update_db)
+        if args.update_db:
+            update_db(args.fetch_chunk_size, args.n_workers)
     if args.reset_cache:
         clear_db(query_map_path)
         clear_db(query_db_path)
+    if args.scorer == "matrix":
+        if load_document_matrix() is None:
+            raise FileNotFoundError("No document matrix at {}, run with --reset_db".format(doc_matrix_path))
+        search_sim = document_matrix
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
 
@@ -0,0 +1,184 @@
+import random
+import time
+from argparse import ArgumentParser
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from api import load_document_store, load_inverted_index, search_by_knn, search_inverted_index
+from condition_parser import condition_list, parse_condition_list
+from consts import *
+from db_types import *
+from index import search_max_score
+from migrate import get_schema_version, migrate
+from utils import create_condition_object, parse_query_conditions, process_query
+
+NUM_QUERIES = 100
+QUERY_LENGTH = 3
+SAMPLE_CONDITIONS = [
+    "`WRITTEN BEFORE 5-5-2020`",
+    "`WRITTEN AFTER 1-1-2020 WRITTEN BEFORE 12-31-2020`",
+    "`PUBLISHED BY \"CNN\" HAVING BIAS LEAN LEFT`",
+    "`WRITTEN BY \"Jane Doe\" AND \"John Smith\" HAVING BIAS CENTER`",
+    "`PUBLISHED BY \"Fox News\" WRITTEN AFTER 10-20-2020 HAVING BIAS RIGHT`",
+]
+
+
+def sample_queries(n: int, length: int, seed: int = 0) -> list[str]:
+    # draw terms from the most common postings so queries have plenty of candidates
+    index = load_inverted_index()
+    common_terms = sorted(index.postings, key=lambda term: len(index.postings[term]), reverse=True)[:500]
+    rng = random.Random(seed)
+    return [" ".join(rng.sample(common_terms, length)) for _ in range(n)]
+
+
+def benchmark_max_score(queries: list[str], k: int) -> None:
+    store = load_document_store()
+    index = load_inverted_index()
+    exhaustive_scored = 0
+    candidates_scored = 0
+    max_score_scored = 0
+    times = {"exhaustive": 0.0, "inverted index": 0.0, "max score": 0.0}
+    for query in queries:
+        query_vec = process_query(query)
+        start = time.perf_counter()
+        expected = search_by_knn(query_vec, store.items(), k)
+        times["exhaustive"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        search_inverted_index(query_vec, index, store, k)
+        times["inverted index"] += time.perf_counter() - start
+
+        stats = {}
+        start = time.perf_counter()
+        results = search_max_score(query_vec, index, store, k, stats=stats)
+        times["max score"] += time.perf_counter() - start
+        if results is not None and results != expected:
+            raise AssertionError("MaxScore results differ from exhaustive scoring for {!r}".format(query))
+
+        exhaustive_scored += len(store)
+        candidates_scored += len(index.candidates(query_vec))
+        max_score_scored += stats.get("scored", 0)
+    print("{} queries, k={}, {} documents".format(len(queries), k, len(store)))
+    print("documents scored: exhaustive {}, inverted index {}, max score {}".format(
+        exhaustive_scored, candidates_scored, max_score_scored))
+    for name, seconds in times.items():
+        print("{}: {:.2f} ms/query".format(name, 1000 * seconds / len(queries)))
+
+
+def sample_lookups(session, n: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    articles = session.query(Article.PublishDate, Article.Aname, NewsSource.NewsSourceName) \
+        .join(NewsSource, NewsSource.NewsSourceID == Article.NewsSourceID).all()
+    keywords = [word for word, in session.query(KeyWord.KeyWord)]
+    authors = [name for name, in session.query(Author.AName)]
+    return {
+        "dates": [date for date, _, _ in rng.sample(articles, min(n, len(articles))) if date is not None],
+        "titles": [(source, title) for _, title, source in rng.sample(articles, min(n, len(articles)))],
+        "keywords": rng.sample(keywords, min(n, len(keywords))),
+        "authors": rng.sample(authors, min(n, len(authors)))
+    }
+
+
+def benchmark_lookups(session, lookups: dict) -> dict:
+    '''
+    ms per query of the lookups the API and loader run against the MySQL schema
+    '''
+    def time_queries(values, run_query):
+        start = time.perf_counter()
+        for value in values:
+            run_query(value)
+        return 1000 * (time.perf_counter() - start) / max(len(values), 1)
+
+    def article_not_included(value):
+        source, title = value
+        news_source_id = session.query(NewsSource.NewsSourceID).filter(NewsSource.NewsSourceName == source).first()
+        session.query(Article).filter(Article.Aname == title).filter(Article.NewsSourceID == news_source_id[0]).first()
+
+    return {
+        "articles by date": time_queries(lookups["dates"], lambda date: session.query(Article.ArticleID)
+                                         .filter(Article.PublishDate == date).all()),
+        "article by source and title": time_queries(lookups["titles"], article_not_included),
+        "keyword by name": time_queries(lookups["keywords"], lambda word: session.query(KeyWord)
+                                        .filter_by(KeyWord=word).first()),
+        "author by name": time_queries(lookups["authors"], lambda name: session.query(Author)
+                                       .filter_by(AName=name).first())
+    }
+
+
+def benchmark_migration(db_url: str, n: int, apply: bool) -> None:
+    engine = create_engine(db_url)
+    session = sessionmaker(bind=engine)()
+    lookups = sample_lookups(session, n)
+    print("schema version {}".format(get_schema_version(engine)))
+    before = benchmark_lookups(session, lookups)
+    if not apply:
+        for name, ms in before.items():
+            print("{}: {:.2f} ms/query".format(name, ms))
+        return
+    session.close()
+    migrate(engine)
+    after = benchmark_lookups(session, lookups)
+    for name in before:
+        print("{}: {:.2f} -> {:.2f} ms/query".format(name, before[name], after[name]))
+
+
+def benchmark_condition_parser(n: int) -> None:
+    '''
+    Parsing the SAMPLE_CONDITIONS n times each with the pyparsing grammar, the hand-written
+    parser, and the memoized parse_query_conditions
+    '''
+    def pyparsing_conditions(conditions):
+        parsed = condition_list.parseString(conditions)
+        return [create_condition_object(parsed[i]) for i in range(1, len(parsed) - 1)]
+
+    def parser_conditions(conditions):
+        return [create_condition_object(raw_condition) for raw_condition in parse_condition_list(conditions)]
+
+    for conditions in SAMPLE_CONDITIONS:
+        if condition_list.parseString(conditions).asList()[1:-1] != parse_condition_list(conditions):
+            raise AssertionError("parse_condition_list differs from the pyparsing grammar for {!r}".format(conditions))
+    parse_query_conditions.cache_clear()
+    parsers = {"pyparsing": pyparsing_conditions, "hand-written": parser_conditions,
+               "hand-written, cached": parse_query_conditions}
+    for name, parse in parsers.items():
+        start = time.perf_counter()
+        for _ in range(n):
+            for conditions in SAMPLE_CONDITIONS:
+                parse(conditions)
+        seconds = time.perf_counter() - start
+        print("{}: {:.1f} us/condition string".format(name, 1e6 * seconds / (n * len(SAMPLE_CONDITIONS))))
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--queries", type=str, default=None, help="file with one query per line")
+    parser.add_argument("--num_queries", type=int, default=NUM_QUERIES)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--lookups", dest="lookups", action="store_true",
+                        help="time the database lookups instead of document scoring")
+    parser.set_defaults(lookups=False)
+    parser.add_argument("--migrate", dest="migrate", action="store_true",
+                        help="with --lookups, apply pending schema migrations and time the lookups again")
+    parser.set_defaults(migrate=False)
+    parser.add_argument("--conditions", dest="conditions", action="store_true",
+                        help="time parsing query conditions instead of document scoring")
+    parser.set_defaults(conditions=False)
+    parser.add_argument("--db_url", type=str, default="mysql+pymysql://db_final:password@" + AWS_IP + "/db_final_db")
+    args = parser.parse_args()
+    if args.conditions:
+        benchmark_condition_parser(args.num_queries)
+        return
+    if args.lookups:
+        benchmark_migration(args.db_url, args.num_queries, args.migrate)
+        return
+    if args.queries is not None:
+        with open(args.queries) as fp:
+            queries = [line.strip() for line in fp if line.strip()]
+    else:
+        queries = sample_queries(args.num_queries, QUERY_LENGTH)
+    benchmark_max_score(queries, args.k)
+
+
+if __name__ == "__main__":
+    main()
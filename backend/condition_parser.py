@@ -1,3 +1,5 @@
+import re
+
 import pyparsing as pp
 
 WRITTEN_BY_TOK = "WRITTEN BY"
@@ -39,6 +41,80 @@ query_condition = author_string ^ before_string ^ after_string ^ news_source_str
 condition_list = "`" + query_condition[1, ...] + "`"
 
 
+class ConditionSyntaxError(ValueError):
+    pass
+
+
+# the same tokens as the grammar above, for parse_condition_list
+whitespace_re = re.compile("[ \t\r\n]*")
+quoted_re = re.compile("\"([^\"\n\r]*)\"")
+date_re = re.compile("[0-9]{1,2}-[0-9]{1,2}-[0-9]{4}")
+bias_re = re.compile("|".join(sorted(map(re.escape, ratings_tok_dict), key=len, reverse=True)))
+condition_toks = [WRITTEN_BY_TOK, WRITTEN_BEFORE_TOK, WRITTEN_AFTER_TOK, PUBLISHED_BY_TOK, BIAS_TOK]
+
+
+def parse_condition_list(text: str) -> list[list]:
+    '''
+    Hand-written parser for condition_list, returning the groups condition_list.parseString
+    returns between the backticks, e.g. [["WRITTEN BY", ["A", "AND", "B"]], ["HAVING BIAS", "LEFT"]].
+    Unlike pp.Word, a bias rating only matches one of the ratings_tok_dict names, so it never
+    swallows the space before the next condition.
+    '''
+    # parseString expands tabs before parsing, quoted strings included
+    text = text.expandtabs()
+    pos = 0
+
+    def skip(pos: int) -> int:
+        return whitespace_re.match(text, pos).end()
+
+    def expect(pattern, pos: int, what: str):
+        match = pattern.match(text, skip(pos))
+        if match is None:
+            raise ConditionSyntaxError("Expected {} at char {} in {!r}".format(what, skip(pos), text))
+        return match
+
+    pos = skip(pos)
+    if not text.startswith("`", pos):
+        raise ConditionSyntaxError("Expected '`' at char {} in {!r}".format(pos, text))
+    pos += 1
+    conditions = []
+    while True:
+        pos = skip(pos)
+        if conditions and text.startswith("`", pos):
+            return conditions
+        tok = next((tok for tok in condition_toks if text.startswith(tok, pos)), None)
+        if tok is None:
+            raise ConditionSyntaxError("Expected a condition at char {} in {!r}".format(pos, text))
+        pos += len(tok)
+        if tok == WRITTEN_BY_TOK:
+            match = expect(quoted_re, pos, "an author")
+            authors = [match.group(1)]
+            pos = match.end()
+            while True:
+                and_pos = skip(pos)
+                if not text.startswith(AND_TOKEN, and_pos):
+                    break
+                match = quoted_re.match(text, skip(and_pos + len(AND_TOKEN)))
+                if match is None:
+                    # like the grammar, a dangling AND is left for the next condition to fail on
+                    break
+                authors += [AND_TOKEN, match.group(1)]
+                pos = match.end()
+            conditions.append([tok, authors])
+            continue
+        if tok == PUBLISHED_BY_TOK:
+            match = expect(quoted_re, pos, "a news source")
+            value = match.group(1)
+        elif tok == BIAS_TOK:
+            match = expect(bias_re, pos, "a bias rating")
+            value = match.group(0)
+        else:
+            match = expect(date_re, pos, "a date")
+            value = match.group(0)
+        conditions.append([tok, value])
+        pos = match.end()
+
+
 if __name__ == "__main__":
     string = "`WRITTEN BEFORE 5-5-2020 WRITTEN AFTER 12-12-2020`"
     tree = condition_list.parseString(string)
@@ -1,4 +1,8 @@
-from sqlalchemy import create_engine, MetaData
+import asyncio
+from typing import Iterable, Optional
+
+from sqlalchemy import bindparam, create_engine, false, MetaData, literal, select, union_all
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker, scoped_session
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
@@ -6,7 +10,9 @@ import datetime
 from backend.utils import process_query, BagOfWordsVector, cosine_sim
 from db_types import *
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from consts import AWS_IP
+from trigram_index import TrigramIndex
 
 app = FastAPI()
 
@@ -32,6 +38,27 @@ months = ["january", "february", "march", "april",
 months_abrev = ["jan", "feb", "mar", "apr", "may", "jun",
                 "jul", "aug", "sep", "oct", "nov", "dec"]
 
+# (<match type>, <name>, <ArticleID>) rows matched by FindSimilarNewssource, FindSimilarKeywords,
+# FindSimilarAuthor and FindSimilarTitle, in that order, for the articles above after_id
+similar_name_queries = [
+    select(literal(0), NewsSource.NewsSourceName, Article.ArticleID)
+    .join(Article, Article.NewsSourceID == NewsSource.NewsSourceID)
+    .where(Article.ArticleID > bindparam("after_id")),
+    select(literal(1), KeyWord.KeyWord, HasKeyWord.ArticleID)
+    .join(HasKeyWord, HasKeyWord.KeyWordID == KeyWord.KeyWordID)
+    .where(HasKeyWord.ArticleID > bindparam("after_id")),
+    select(literal(2), Author.AName, WroteBy.ArticleID).join(WroteBy, WroteBy.AuthorID == Author.AuthorID)
+    .where(WroteBy.ArticleID > bindparam("after_id")),
+    select(literal(3), Article.Aname, Article.ArticleID).where(Article.ArticleID > bindparam("after_id"))
+]
+similar_indexes: Optional[list[TrigramIndex]] = None
+# largest ArticleID in similar_indexes, articles loaded later are added by refresh_similar_indexes
+similar_indexes_high_water_mark = 0
+similar_indexes_refresh_lock = asyncio.Lock()
+# seconds between two checks for newly loaded articles
+similar_indexes_refresh_interval = 60
+similar_indexes_refresh_task: Optional[asyncio.Task] = None
+
 
 def remove_repeat_articles(articles: list[Article]) -> list[Article]:
     new_article_info = set()
@@ -69,21 +96,49 @@ def convert_to_datetime(date: str):
     return formatted_date
 
 
+def date_range_conditions(restrictions: list[tuple[str, str]]) -> Optional[list]:
+    """
+        Collapses (<date>, <modifier>) restrictions into the tightest bounds on PublishDate, None if
+        none of the dates can be parsed
+        """
+    lower, upper, exact = None, None, set()
+    for date, modifier in restrictions:
+        formatted_date = convert_to_datetime(date)
+        if not formatted_date:
+            continue
+        if modifier in before:
+            upper = formatted_date if upper is None else min(upper, formatted_date)
+        elif modifier in after:
+            lower = formatted_date if lower is None else max(lower, formatted_date)
+        elif modifier in on:
+            exact.add(formatted_date)
+    if lower is None and upper is None and len(exact) == 0:
+        return None
+    conditions = []
+    if lower is not None:
+        conditions.append(Article.PublishDate > lower)
+    if upper is not None:
+        conditions.append(Article.PublishDate < upper)
+    if len(exact) > 0:
+        # published on more than one day never matches
+        conditions.append(Article.PublishDate == exact.pop() if len(exact) == 1 else false())
+    return conditions
+
+
+def get_articles_in_date_range(restrictions: list[tuple[str, str]]) -> Optional[list]:
+    """
+        ArticleIDs satisfying every restriction, from a single range query, None if there is no
+        usable restriction
+        """
+    conditions = date_range_conditions(restrictions)
+    if conditions is None:
+        return None
+    return [article_id for article_id, in session.query(Article.ArticleID).filter(*conditions)]
+
+
 def get_articles_by_date(date: str, modifier: str):
-    article_ids = []
-    formatted_date = convert_to_datetime(date)
-    if not formatted_date:
-        return article_ids
-    if modifier in before:
-        article_ids += (session.query(Article.ArticleID).filter(Article.PublishDate < formatted_date).all())
-    elif modifier in after:
-        article_ids += (session.query(Article.ArticleID).filter(Article.PublishDate > formatted_date).all())
-    elif modifier in on:
-        article_ids += (session.query(Article.ArticleID).filter(Article.PublishDate == formatted_date).all())
-    just_articles_ids = []
-    for article_id in article_ids:
-        just_articles_ids.append(article_id[0])
-    return just_articles_ids
+    article_ids = get_articles_in_date_range([(date, modifier)])
+    return [] if article_ids is None else article_ids
 
 
 def check_next_three_words(modifier: str, processed_query: BagOfWordsVector) -> str:
@@ -134,51 +189,101 @@ def get_nearest(processed_query: BagOfWordsVector,
     modifier = ""
     date = ""
     date_restrictions = []
+    similar_tokens = []
     for s in processed_query:
         if next_date:
             next_date = False
-            if date != "":
-                if len(date_restrictions) == 0:
-                    date_restrictions += get_articles_by_date(date, modifier)
-                else:
-                    date_restrictions = [value for value in date_restrictions if value in
-                                         get_articles_by_date(date, modifier)]
-            else:
-                if len(date_restrictions) == 0:
-                    date_restrictions += get_articles_by_date(s, modifier)
-                else:
-                    date_restrictions = [value for value in date_restrictions if value in
-                                         get_articles_by_date(s, modifier)]
+            date_restrictions.append((date if date != "" else s, modifier))
         elif s in before or s in after or s in on:
             next_date = True
             modifier = s
             date = check_next_three_words(modifier, processed_query)
         else:
-            article_ids += (get_articles_with_similar(s))
-    if len(article_ids) == 0 and len(date_restrictions) != 0:
-        return date_restrictions
-    elif len(article_ids) != 0 and len(date_restrictions) == 0:
+            similar_tokens.append(s)
+    matches = get_articles_with_similar_tokens(similar_tokens)
+    for s in similar_tokens:
+        article_ids += matches[s]
+    dated_article_ids = get_articles_in_date_range(date_restrictions)
+    if not dated_article_ids:
         return article_ids
-    else:
-        return [value for value in date_restrictions if value in article_ids]
+    if len(article_ids) == 0:
+        return dated_article_ids
+    matched = set(article_ids)
+    return [value for value in dated_article_ids if value in matched]
 
 
-def get_articles_with_similar(s: str) -> list:
-    article_ids = []
+def fetch_similar_names(after_id: int) -> list:
+    # every match type in one round trip, and so from one consistent read
     with engine.connect() as conn:
-        result = conn.execute("CALL FindSimilarNewssource(%s)", s)
-        result2 = conn.execute("CALL FindSimilarKeywords(%s)", s)
-        result3 = conn.execute("CALL FindSimilarAuthor(%s)", s)
-        result4 = conn.execute("CALL FindSimilarTitle(%s)", s)
-        for row in result:
-            article_ids.append(row["ArticleID"])
-        for row in result2:
-            article_ids.append(row["ArticleID"])
-        for row in result3:
-            article_ids.append(row["ArticleID"])
-        for row in result4:
-            article_ids.append(row["ArticleID"])
-    return article_ids
+        return conn.execute(union_all(*similar_name_queries), {"after_id": after_id}).all()
+
+
+def add_similar_names(indexes: list[TrigramIndex], rows: list) -> None:
+    global similar_indexes_high_water_mark
+    for match_type, name, article_id in rows:
+        indexes[match_type].add(name, article_id)
+        similar_indexes_high_water_mark = max(similar_indexes_high_water_mark, article_id)
+
+
+@app.on_event("startup")
+def load_similar_indexes() -> list[TrigramIndex]:
+    global similar_indexes
+    if similar_indexes is None:
+        indexes = [TrigramIndex() for _ in similar_name_queries]
+        add_similar_names(indexes, fetch_similar_names(similar_indexes_high_water_mark))
+        similar_indexes = indexes
+    return similar_indexes
+
+
+async def refresh_similar_indexes() -> int:
+    """
+        Adds the names of the articles loaded since the indexes were last read, i.e. with an
+        ArticleID above the high-water mark. The rows are fetched off the event loop but added
+        on it, where every lookup runs, so no lookup sees a partly added batch.
+        Returns the number of rows added.
+        """
+    async with similar_indexes_refresh_lock:
+        indexes = load_similar_indexes()
+        rows = await run_in_threadpool(fetch_similar_names, similar_indexes_high_water_mark)
+        add_similar_names(indexes, rows)
+    return len(rows)
+
+
+async def refresh_similar_indexes_periodically() -> None:
+    while True:
+        await asyncio.sleep(similar_indexes_refresh_interval)
+        try:
+            await refresh_similar_indexes()
+        except SQLAlchemyError as e:
+            print("Could not refresh the similar name indexes: {}".format(e))
+
+
+@app.on_event("startup")
+async def start_similar_indexes_refresh() -> None:
+    global similar_indexes_refresh_task
+    similar_indexes_refresh_task = asyncio.create_task(refresh_similar_indexes_periodically())
+
+
+@app.post("/index/update")
+async def update_similar_indexes() -> dict:
+    added = await refresh_similar_indexes()
+    return {"added": added, "high_water_mark": similar_indexes_high_water_mark}
+
+
+def get_articles_with_similar_tokens(tokens: Iterable[str]) -> dict[str, list]:
+    """
+        ArticleIDs matched by each distinct token over all four match types
+        """
+    indexes = load_similar_indexes()
+    matches = {}
+    for token in tokens:
+        if token not in matches:
+            matches[token] = [article_id for index in indexes for article_id in index.search(token)]
+    return matches
+
+
+def get_articles_with_similar(s: str) -> list:
+    return get_articles_with_similar_tokens([s])[s]
 
 
 def main() -> None:
@@ -1,8 +1,12 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, insert
+from sqlalchemy.dialects import mysql, sqlite
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
 
+# lookup names compared byte for byte on MySQL, like the in-memory maps in load_db.py
+LookupName = String(255).with_variant(mysql.VARCHAR(255, collation="utf8mb4_bin"), "mysql")
+
 
 class Article(Base):
     __tablename__ = "Articles"
@@ -13,6 +17,11 @@ class Article(Base):
     NewsSourceID = Column(Integer)
     ArticleText = Column(Text)
     ArticleSummary = Column(Text)
+    __table_args__ = (
+        Index("ix_Articles_PublishDate", "PublishDate"),
+        Index("ix_Articles_NewsSourceID_AName", "NewsSourceID", "Aname", mysql_length={"Aname": 255}),
+        Index("ix_Articles_URL", "URL", mysql_length=255),
+    )
 
 
 class WroteBy(Base):
@@ -26,7 +35,10 @@ class WroteBy(Base):
 class Author(Base):
     __tablename__ = "Author"
     AuthorID = Column(Integer, primary_key=True)
-    AName = Column(Text, nullable=False)
+    AName = Column(String(255), nullable=False)
+    __table_args__ = (
+        Index("ix_Author_AName", "AName"),
+    )
 
 
 class BiasType(Base):
@@ -38,15 +50,21 @@ class BiasType(Base):
 class NewsSource(Base):
     __tablename__ = "NewsSource"
     NewsSourceID = Column(Integer, primary_key=True, nullable=False)
-    NewsSourceName = Column(Text, nullable=False)
+    NewsSourceName = Column(String(255), nullable=False)
     Homepage = Column(Text, nullable=False)
     BiasID = Column(Integer, ForeignKey("BiasType.BiasID"))
+    __table_args__ = (
+        Index("ux_NewsSource_NewsSourceName", "NewsSourceName", unique=True),
+    )
 
 
 class KeyWord(Base):
     __tablename__ = "KeyWord"
     KeyWordID = Column(Integer, primary_key=True, nullable=False)
-    KeyWord = Column(Text, nullable=False)
+    KeyWord = Column(LookupName, nullable=False)
+    __table_args__ = (
+        Index("ux_KeyWord_KeyWord", "KeyWord", unique=True),
+    )
 
 
 class HasKeyWord(Base):
@@ -54,3 +72,53 @@ class HasKeyWord(Base):
     KeyWordID = Column(Integer, ForeignKey("KeyWord.KeyWordID"), primary_key=True, nullable=False)
     ArticleID = Column(Integer, ForeignKey("Articles.ArticleID"), primary_key=True, nullable=False)
 
+
+# Staging tables for set-based ingest, see staging.py and MergeStagedStories
+class StagingArticle(Base):
+    __tablename__ = "StagingArticle"
+    StageID = Column(Integer, primary_key=True, nullable=False)
+    NewsSourceName = Column(Text, nullable=False)
+    Homepage = Column(Text, nullable=False)
+    BiasID = Column(Integer)
+    Title = Column(Text, nullable=False)
+    URL = Column(Text, nullable=False)
+    PublishDate = Column(DateTime)
+    ArticleText = Column(Text)
+    ArticleSummary = Column(Text, nullable=False)
+    # filled in by the merge with the ArticleID the story ended up under
+    ArticleID = Column(Integer)
+
+
+class StagingAuthor(Base):
+    __tablename__ = "StagingAuthor"
+    StageID = Column(Integer, primary_key=True, nullable=False)
+    AName = Column(String(255), primary_key=True, nullable=False)
+
+
+class StagingKeyWord(Base):
+    __tablename__ = "StagingKeyWord"
+    StageID = Column(Integer, primary_key=True, nullable=False)
+    KeyWord = Column(LookupName, primary_key=True, nullable=False)
+
+
+class SchemaVersion(Base):
+    __tablename__ = "SchemaVersion"
+    Version = Column(Integer, primary_key=True, nullable=False)
+    Description = Column(Text, nullable=False)
+    AppliedAt = Column(DateTime, nullable=False)
+
+
+def insert_skip_existing(model, dialect: str):
+    '''
+    INSERT that skips rows whose key already exists instead of failing the statement. Unlike
+    INSERT IGNORE, foreign key and truncation errors still fail it, so a bad row is never
+    dropped silently.
+    '''
+    if dialect == "mysql":
+        stmt = mysql.insert(model)
+        # assigning a key column to itself leaves the existing row as it is
+        key = next(iter(model.__table__.primary_key.columns))
+        return stmt.on_duplicate_key_update({key.name: key})
+    if dialect == "sqlite":
+        return sqlite.insert(model).on_conflict_do_nothing()
+    return insert(model)
@@ -0,0 +1,142 @@
+import pickle
+from datetime import datetime
+from typing import Iterable, NamedTuple, Optional
+
+import numpy as np
+
+
+class DocMetadata(NamedTuple):
+    publish_date: Optional[datetime]
+    publisher: Optional[str]
+    bias_id: Optional[int]
+    authors: list[str]
+
+
+def name_key(name: str) -> str:
+    # NewsSourceName and AName compare case-insensitively in MySQL, so the bitmaps do too
+    return name.casefold()
+
+
+class DocumentFilters:
+    '''
+    In-memory metadata for evaluating query conditions before scoring. Documents are ordinals
+    in the order of doc_ids, the iteration order of the document store, so a mask lines
+    up with the inverted index and the document matrix. Bias ratings and publishers have one
+    bitmap per value, authors a sorted array of ordinals each (a bitmap per author would not fit
+    in memory), and publish dates are kept sorted with the ordinals they belong to.
+
+    Documents are appended at the end. A bitmap only grows when one of its values is appended,
+    shorter bitmaps are padded with False when read.
+    '''
+
+    def __init__(self, doc_ids: list, metadata: Iterable[Optional[DocMetadata]]):
+        self.doc_ids = []
+        self.ordinal_of = {}
+        # documents joined to a news source, the only ones get_articles_by_id can return
+        self.has_publisher = np.zeros(0, dtype=bool)
+        self.bias: dict[int, np.ndarray] = {}
+        self.publishers: dict[str, np.ndarray] = {}
+        self.authors: dict[str, np.ndarray] = {}
+        self.sorted_dates = np.zeros(0, dtype="datetime64[us]")
+        self.date_ordinals = np.zeros(0, dtype=np.int64)
+        self.append(doc_ids, metadata)
+
+    def append(self, doc_ids: list, metadata: Iterable[Optional[DocMetadata]]) -> None:
+        start = len(self.doc_ids)
+        for ordinal, doc_id in enumerate(doc_ids, start):
+            self.doc_ids.append(doc_id)
+            self.ordinal_of[doc_id] = ordinal
+        self.has_publisher = self.fit(self.has_publisher)
+        publishers: dict[str, list[int]] = {}
+        bias: dict[int, list[int]] = {}
+        authors: dict[str, list[int]] = {}
+        dated_ordinals = []
+        dates = []
+        for ordinal, meta in enumerate(metadata, start):
+            if meta is None:
+                continue
+            if meta.publisher is not None:
+                self.has_publisher[ordinal] = True
+                publishers.setdefault(name_key(meta.publisher), []).append(ordinal)
+            if meta.bias_id is not None:
+                bias.setdefault(meta.bias_id, []).append(ordinal)
+            for author in {name_key(author) for author in meta.authors}:
+                authors.setdefault(author, []).append(ordinal)
+            if meta.publish_date is not None:
+                dated_ordinals.append(ordinal)
+                dates.append(np.datetime64(meta.publish_date, "us"))
+        for bitmaps, ordinals in ((self.publishers, publishers), (self.bias, bias)):
+            for value, value_ordinals in ordinals.items():
+                bitmap = self.fit(bitmaps.get(value, np.zeros(0, dtype=bool)))
+                bitmap[value_ordinals] = True
+                bitmaps[value] = bitmap
+        for author, author_ordinals in authors.items():
+            self.authors[author] = np.concatenate((self.authors.get(author, np.zeros(0, dtype=np.int64)),
+                                                   np.array(author_ordinals, dtype=np.int64)))
+        dates = np.array(dates, dtype="datetime64[us]")
+        order = np.argsort(dates, kind="stable")
+        # after every equal date already indexed, so ties stay in ordinal order
+        positions = np.searchsorted(self.sorted_dates, dates[order], "right")
+        self.sorted_dates = np.insert(self.sorted_dates, positions, dates[order])
+        self.date_ordinals = np.insert(self.date_ordinals, positions,
+                                       np.array(dated_ordinals, dtype=np.int64)[order])
+
+    def fit(self, bitmap: np.ndarray) -> np.ndarray:
+        # bitmap padded with False up to the number of documents
+        if len(bitmap) == len(self):
+            return bitmap
+        return np.concatenate((bitmap, np.zeros(len(self) - len(bitmap), dtype=bool)))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def empty(self) -> np.ndarray:
+        return np.zeros(len(self), dtype=bool)
+
+    def bias_mask(self, bias_id: int) -> np.ndarray:
+        return self.fit(self.bias.get(bias_id, self.empty()))
+
+    def publisher_mask(self, publisher: str) -> np.ndarray:
+        return self.fit(self.publishers.get(name_key(publisher), self.empty()))
+
+    def author_mask(self, author: str) -> np.ndarray:
+        mask = self.empty()
+        mask[self.authors.get(name_key(author), [])] = True
+        return mask
+
+    def date_mask(self, after: Optional[datetime] = None, before: Optional[datetime] = None) -> np.ndarray:
+        '''
+        Documents published strictly after after and strictly before before
+        '''
+        start = 0 if after is None else np.searchsorted(self.sorted_dates, np.datetime64(after, "us"), "right")
+        end = len(self.sorted_dates) if before is None \
+            else np.searchsorted(self.sorted_dates, np.datetime64(before, "us"), "left")
+        mask = self.empty()
+        mask[self.date_ordinals[start:end]] = True
+        return mask
+
+    def candidates(self, conditions: list) -> Optional[np.ndarray]:
+        '''
+        Mask of the documents satisfying every condition, None when nothing is filtered
+        '''
+        mask = None
+        for condition in conditions:
+            condition_mask = condition.mask(self)
+            if condition_mask is not None:
+                mask = condition_mask.copy() if mask is None else mask & condition_mask
+        if mask is None:
+            return None
+        return mask & self.has_publisher
+
+    def ordinals_of(self, doc_ids: Iterable) -> np.ndarray:
+        # positions in this index of doc_ids listed in another order, e.g. the field index
+        return np.array([self.ordinal_of.get(doc_id, -1) for doc_id in doc_ids], dtype=np.int64)
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as fp:
+            pickle.dump(self, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path: str) -> "DocumentFilters":
+        with open(path, "rb") as fp:
+            return pickle.load(fp)
@@ -0,0 +1,140 @@
+from typing import Iterable, Optional
+
+import numpy as np
+
+from utils import BagOfWordsVector, DocFreqs, cosine_sim
+
+
+class DocumentMatrix:
+    '''
+    CSR-style document x term matrix over the document store. Terms are interned into integer
+    ids, so scoring a query is a single sparse matrix-vector product. Rows follow the order of
+    doc_ids and hold raw term frequencies; new documents are appended as rows.
+
+    idf is applied when scoring: the tf-idf entries and the L2 norm of every row are computed
+    in one vectorized pass the first time they are needed after rows are appended or doc_freqs
+    is replaced, and reused by every query until then.
+
+    Instances can be passed as the sim= argument of get_nearest, which then scores every
+    document in one pass. Called pairwise they behave like cosine_sim.
+    '''
+
+    def __init__(self, doc_ids: list, vocab: list[str], indptr: np.ndarray, indices: np.ndarray,
+                 data: np.ndarray, doc_freqs: Optional[DocFreqs] = None):
+        self.doc_ids = doc_ids
+        self.vocab = vocab
+        self.term_ids = {term: i for i, term in enumerate(vocab)}
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        # row of every stored entry, used to sum products back into per-document scores
+        self.rows = np.repeat(np.arange(len(doc_ids)), np.diff(indptr))
+        self.set_doc_freqs(doc_freqs)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __call__(self, x: BagOfWordsVector, y: BagOfWordsVector) -> float:
+        return cosine_sim(x, y)
+
+    def set_doc_freqs(self, doc_freqs: Optional[DocFreqs]) -> None:
+        self.doc_freqs = doc_freqs
+        self._weights: Optional[tuple[np.ndarray, np.ndarray]] = None
+
+    def weights(self) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        (<tf-idf of every stored entry>, <norm of every row>) under the idf of doc_freqs
+        '''
+        weights = self._weights
+        if weights is None:
+            data = self.data
+            if self.doc_freqs is not None:
+                data = data * self.doc_freqs.idfs(self.vocab)[self.indices]
+            norms = np.sqrt(np.bincount(self.rows, weights=data * data, minlength=len(self)))
+            weights = self._weights = (data, norms)
+        return weights
+
+    def query_vector(self, query_vec: BagOfWordsVector) -> np.ndarray:
+        dense = np.zeros(len(self.vocab))
+        for term, weight in query_vec.items():
+            term_id = self.term_ids.get(term)
+            if term_id is not None:
+                dense[term_id] = weight
+        return dense
+
+    def score(self, query_vec: BagOfWordsVector) -> np.ndarray:
+        '''
+        Cosine similarity between the query and every document, aligned with doc_ids
+        '''
+        data, norms = self.weights()
+        dense = self.query_vector(query_vec)
+        dots = np.bincount(self.rows, weights=data * dense[self.indices], minlength=len(self))
+        # the query norm includes terms outside the vocabulary, as in cosine_sim
+        denom = norms * np.linalg.norm(list(query_vec.values()))
+        return np.divide(dots, denom, out=np.zeros(len(self)), where=dots != 0)
+
+    def score_rows(self, query_vec: BagOfWordsVector, rows: np.ndarray) -> np.ndarray:
+        '''
+        Cosine similarity between the query and the given rows only, aligned with rows. Only the
+        stored entries of those rows are read.
+        '''
+        data, norms = self.weights()
+        dense = self.query_vector(query_vec)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        # position in indices/data of every stored entry of the selected rows
+        offsets = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        local_rows = np.repeat(np.arange(len(rows)), lengths)
+        dots = np.bincount(local_rows, weights=data[offsets] * dense[self.indices[offsets]],
+                           minlength=len(rows))
+        denom = norms[rows] * np.linalg.norm(list(query_vec.values()))
+        return np.divide(dots, denom, out=np.zeros(len(rows)), where=dots != 0)
+
+    def append(self, doc_pairs: Iterable[tuple]) -> int:
+        '''
+        Appends one row per (<doc_id>, <term frequencies>) pair, interning new terms after the
+        existing vocabulary. Existing rows are not touched. Returns the number of rows appended.
+        '''
+        start = len(self)
+        indptr = []
+        indices = []
+        data = []
+        for doc_id, tf in doc_pairs:
+            self.doc_ids.append(doc_id)
+            for term, weight in tf.items():
+                term_id = self.term_ids.get(term)
+                if term_id is None:
+                    term_id = self.term_ids[term] = len(self.vocab)
+                    self.vocab.append(term)
+                indices.append(term_id)
+                data.append(weight)
+            indptr.append(len(self.indices) + len(indices))
+        if len(self) == start:
+            return 0
+        self.indptr = np.concatenate((self.indptr, np.array(indptr, dtype=np.int64)))
+        self.indices = np.concatenate((self.indices, np.array(indices, dtype=np.int64)))
+        self.data = np.concatenate((self.data, np.array(data, dtype=np.float64)))
+        self.rows = np.concatenate((self.rows, np.repeat(np.arange(start, len(self)),
+                                                         np.diff(self.indptr[start:]))))
+        self._weights = None
+        return len(self) - start
+
+    def save(self, path: str) -> None:
+        np.savez(path, doc_ids=np.array(self.doc_ids), vocab=np.array(self.vocab),
+                 indptr=self.indptr, indices=self.indices, data=self.data)
+
+    @staticmethod
+    def load(path: str) -> "DocumentMatrix":
+        with np.load(path) as arrays:
+            return DocumentMatrix(arrays["doc_ids"].tolist(), arrays["vocab"].tolist(),
+                                  arrays["indptr"], arrays["indices"], arrays["data"])
+
+
+def build_document_matrix(doc_pairs: Iterable[tuple]) -> DocumentMatrix:
+    '''
+    doc_pairs must be an iterable of (<doc_id>, <term frequencies>) tuples in store order
+    '''
+    matrix = DocumentMatrix([], [], np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                            np.zeros(0, dtype=np.float64))
+    matrix.append(doc_pairs)
+    return matrix
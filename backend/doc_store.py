@@ -0,0 +1,59 @@
+from collections.abc import Mapping
+from typing import Iterable, Optional
+
+from sqlitedict import SqliteDict
+
+from utils import BagOfWordsVector, DocFreqs, weight_tf, weight_tfs
+
+
+class DocumentStore(Mapping):
+    '''
+    In-memory copy of the term frequency store (doc_tfs.db). The SqliteDict file is only the
+    persistence format; it is read once and every request handler shares this copy.
+    Iteration follows the order of the SqliteDict, and new documents are appended to it.
+
+    Documents are kept as raw term frequencies, so adding documents only replaces doc_freqs
+    instead of re-weighting the stored vectors. The tf-idf vectors served to readers are
+    computed in one vectorized pass whenever doc_freqs is replaced, and a document added in
+    between is weighted on its own. Without doc_freqs the raw term frequencies are served.
+    '''
+
+    def __init__(self, tf_pairs: Iterable[tuple], doc_freqs: Optional[DocFreqs] = None):
+        self._tfs: dict[str, BagOfWordsVector] = dict(tf_pairs)
+        self.set_doc_freqs(doc_freqs)
+
+    def __getitem__(self, doc_id) -> BagOfWordsVector:
+        # SqliteDict hands back its keys as strings, request bodies carry ints
+        return self._vectors[str(doc_id)]
+
+    def __iter__(self):
+        return iter(self._tfs)
+
+    def __len__(self):
+        return len(self._tfs)
+
+    def __contains__(self, doc_id):
+        # without reading, and weighting, the document
+        return str(doc_id) in self._tfs
+
+    def tf(self, doc_id) -> BagOfWordsVector:
+        return self._tfs[str(doc_id)]
+
+    def set_doc_freqs(self, doc_freqs: Optional[DocFreqs]) -> None:
+        self.doc_freqs = doc_freqs
+        if doc_freqs is None:
+            self._vectors = self._tfs
+        else:
+            self._vectors = dict(zip(self._tfs, weight_tfs(list(self._tfs.values()), doc_freqs, verbose=False)))
+
+    def add(self, doc_id, tf: BagOfWordsVector) -> None:
+        self._tfs[str(doc_id)] = tf
+        if self.doc_freqs is not None:
+            self._vectors[str(doc_id)] = weight_tf(tf, self.doc_freqs)
+
+    @staticmethod
+    def load(path: str, doc_freqs: Optional[DocFreqs] = None) -> "DocumentStore":
+        db = SqliteDict(path)
+        store = DocumentStore(db.items(), doc_freqs)
+        db.close()
+        return store
@@ -7,10 +7,9 @@ from typing import Union
 import matplotlib.pyplot as plt
 import numpy as np
 from GoogleNews import GoogleNews
-from sqlitedict import SqliteDict
 from tqdm import tqdm
 
-from api import get_nearest, doc_vecs_db_path
+from api import get_articles_by_id, get_nearest
 from utils import string2vec
 
 NUM_QUERIES = 100
@@ -93,10 +92,10 @@ def main() -> None:
         pickle.dump(query2urls_relevant, outfile, protocol=pickle.HIGHEST_PROTOCOL)
     # Obtain ordering of documents from our system for the same evaluation queries
     query2urls_results = {}
-    doc_vecs_db = SqliteDict(doc_vecs_db_path)
     for query, _ in tqdm(queries2count, total=NUM_QUERIES, desc='Our System Step'):
         doc_ids: list[str] = get_nearest(string2vec(query), return_all=True)
-        query2urls_results[query] = [doc_vecs_db[doc_id].link for doc_id in doc_ids]
+        links = {article["doc_id"]: article["link"] for article in get_articles_by_id([int(doc_id) for doc_id in doc_ids], [])}
+        query2urls_results[query] = [links[int(doc_id)] for doc_id in doc_ids if int(doc_id) in links]
     # Compute precision at
     median_ranks = []
     intersection_sizes = []
@@ -0,0 +1,120 @@
+import heapq
+import math
+import pickle
+from collections import Counter
+from typing import Iterable, Optional
+
+import numpy as np
+
+from utils import ArticleData, ArticleDataWeights, BagOfWordsVector
+
+# field order shared by ArticleData and ArticleDataWeights
+FIELDS = ArticleDataWeights._fields
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class FieldIndex:
+    '''
+    Field-separated postings for BM25F. Each posting is an (<ordinal>, <term frequencies>)
+    pair, with one frequency per field in FIELDS, and field_lengths holds the number of tokens
+    of every field of every document. Field weights are only applied when scoring, so they can
+    change per request without reindexing.
+    '''
+
+    def __init__(self):
+        self.doc_ids = []
+        self.postings: dict[str, list[tuple[int, tuple]]] = {}
+        self.field_lengths: dict[str, list[int]] = {field: [] for field in FIELDS}
+        self._length_norms = None
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def add_document(self, doc_id, doc: ArticleData) -> int:
+        ordinal = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        counts = {}
+        for field in FIELDS:
+            tokens = list(getattr(doc, field))
+            self.field_lengths[field].append(len(tokens))
+            counts[field] = Counter(tokens)
+        terms = set()
+        for field in FIELDS:
+            terms.update(counts[field])
+        for term in terms:
+            tfs = tuple(counts[field][term] for field in FIELDS)
+            self.postings.setdefault(term, []).append((ordinal, tfs))
+        self._length_norms = None
+        return ordinal
+
+    def length_norms(self) -> list[list[float]]:
+        '''
+        Per-field BM25 length normalization (1 - b) + b * length / average length for every document
+        '''
+        if self._length_norms is None:
+            norms = []
+            for field in FIELDS:
+                lengths = np.array(self.field_lengths[field], dtype=np.float64)
+                avg_length = lengths.mean() if len(lengths) > 0 else 0
+                if avg_length == 0:
+                    norms.append([1.0] * len(lengths))
+                else:
+                    norms.append(((1 - BM25_B) + BM25_B * lengths / avg_length).tolist())
+            self._length_norms = norms
+        return self._length_norms
+
+    def idf(self, term: str) -> float:
+        df = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self) - df + 0.5) / (df + 0.5))
+
+    def score(self, query_vec: BagOfWordsVector, weights: ArticleDataWeights) -> dict[int, float]:
+        '''
+        BM25F score of every document sharing a term with the query, keyed by ordinal
+        '''
+        norms = self.length_norms()
+        field_weights = [getattr(weights, field) for field in FIELDS]
+        scores = {}
+        for term, query_weight in query_vec.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            idf = self.idf(term)
+            for ordinal, tfs in postings:
+                tf = 0.0
+                for f, field_tf in enumerate(tfs):
+                    if field_tf:
+                        tf += field_weights[f] * field_tf / norms[f][ordinal]
+                scores[ordinal] = scores.get(ordinal, 0.0) + query_weight * idf * tf / (BM25_K1 + tf)
+        return scores
+
+    def save(self, path: str) -> None:
+        self._length_norms = None
+        with open(path, "wb") as fp:
+            pickle.dump(self, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path: str) -> "FieldIndex":
+        with open(path, "rb") as fp:
+            return pickle.load(fp)
+
+
+def build_field_index(doc_ids: Iterable, docs: Iterable[ArticleData]) -> FieldIndex:
+    index = FieldIndex()
+    for doc_id, doc in zip(doc_ids, docs):
+        index.add_document(doc_id, doc)
+    return index
+
+
+def search_bm25f(query_vec: BagOfWordsVector, index: FieldIndex, k: int,
+                 weights: ArticleDataWeights, allowed: Optional[np.ndarray] = None) -> list:
+    '''
+    k best documents by BM25F under the given field weights. Only documents sharing a term with
+    the query, and marked in allowed if given, are returned; ties keep index order.
+    '''
+    scores = index.score(query_vec, weights)
+    if allowed is not None:
+        scores = {ordinal: score for ordinal, score in scores.items() if allowed[ordinal]}
+    top_k = heapq.nsmallest(k, scores.items(), key=lambda item: (-item[1], item[0]))
+    return [index.doc_ids[ordinal] for ordinal, _ in top_k]
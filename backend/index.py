@@ -0,0 +1,183 @@
+import heapq
+import pickle
+from itertools import chain
+from typing import Iterable, Optional
+
+import numpy as np
+from numpy.linalg import norm
+
+from utils import BagOfWordsVector, DocFreqs, cosine_sim
+
+# slack for float rounding between impact bounds and exact cosine scores
+PRUNE_EPSILON = 1e-9
+
+
+class InvertedIndex:
+    '''
+    Term -> postings index over the document store. Postings hold document ordinals,
+    i.e. positions in doc_ids, which follow the iteration order of the store so that
+    ties are broken the same way as a linear scan over the store. Every posting also keeps the
+    raw term frequency, so documents are only ever appended and idf is applied when scoring.
+
+    For every term the index also keeps the largest and smallest impact, i.e. the tf-idf weight
+    of the term divided by the norm of the tf-idf document, over its postings. These bound how
+    much a term can add to a cosine score and drive MaxScore pruning. They depend on idf, so
+    they are recomputed, in one vectorized pass, the first time they are needed after documents
+    are added or doc_freqs is replaced.
+    '''
+
+    def __init__(self):
+        self.doc_ids = []
+        self.postings: dict[str, list[int]] = {}
+        self.tfs: dict[str, list[float]] = {}
+        self.doc_freqs: Optional[DocFreqs] = None
+        self._bounds: Optional[tuple[dict, dict]] = None
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __getstate__(self):
+        # doc_freqs is saved in index_meta.db, bounds are recomputed after loading
+        return dict(self.__dict__, doc_freqs=None, _bounds=None)
+
+    def add_document(self, doc_id, tf: BagOfWordsVector) -> int:
+        ordinal = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        for term, weight in tf.items():
+            self.postings.setdefault(term, []).append(ordinal)
+            self.tfs.setdefault(term, []).append(weight)
+        self._bounds = None
+        return ordinal
+
+    def set_doc_freqs(self, doc_freqs: Optional[DocFreqs]) -> None:
+        self.doc_freqs = doc_freqs
+        self._bounds = None
+
+    def bounds(self) -> tuple[dict[str, float], dict[str, float]]:
+        '''
+        (<max impact>, <min impact>) of every term under the idf of doc_freqs
+        '''
+        bounds = self._bounds
+        if bounds is None:
+            bounds = self._bounds = self.compute_bounds()
+        return bounds
+
+    def compute_bounds(self) -> tuple[dict[str, float], dict[str, float]]:
+        terms = list(self.postings)
+        lengths = np.fromiter((len(self.postings[term]) for term in terms), dtype=np.int64, count=len(terms))
+        total = int(lengths.sum())
+        if total == 0:
+            return {}, {}
+        ordinals = np.fromiter(chain.from_iterable(self.postings[term] for term in terms), dtype=np.int64, count=total)
+        weights = np.fromiter(chain.from_iterable(self.tfs[term] for term in terms), dtype=np.float64, count=total)
+        if self.doc_freqs is not None:
+            weights *= np.repeat(self.doc_freqs.idfs(terms), lengths)
+        doc_norms = np.sqrt(np.bincount(ordinals, weights=weights * weights, minlength=len(self)))[ordinals]
+        impacts = np.divide(weights, doc_norms, out=np.zeros(total), where=doc_norms != 0)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        max_impact = dict(zip(terms, np.maximum.reduceat(impacts, starts).tolist()))
+        min_impact = dict(zip(terms, np.minimum.reduceat(impacts, starts).tolist()))
+        return max_impact, min_impact
+
+    def upper_bound(self, term: str, query_weight: float) -> float:
+        '''
+        Largest contribution of a term to the dot product of a query with a normalized document
+        '''
+        max_impact, min_impact = self.bounds()
+        if query_weight > 0:
+            return query_weight * max_impact[term]
+        return query_weight * min_impact[term]
+
+    def candidates(self, query_vec: BagOfWordsVector) -> list[int]:
+        '''
+        Sorted ordinals of every document sharing at least one term with the query
+        '''
+        ordinals = set()
+        for term in query_vec:
+            ordinals.update(self.postings.get(term, ()))
+        return sorted(ordinals)
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as fp:
+            pickle.dump(self, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path: str) -> "InvertedIndex":
+        with open(path, "rb") as fp:
+            return pickle.load(fp)
+
+
+def build_inverted_index(doc_pairs: Iterable[tuple]) -> InvertedIndex:
+    '''
+    doc_pairs must be an iterable of (<doc_id>, <term frequencies>) tuples in store order
+    '''
+    index = InvertedIndex()
+    for doc_id, tf in doc_pairs:
+        index.add_document(doc_id, tf)
+    return index
+
+
+def search_max_score(query_vec: BagOfWordsVector, index: InvertedIndex, doc_db, k: int,
+                     sim=cosine_sim, stats: Optional[dict] = None,
+                     allowed: Optional[np.ndarray] = None) -> Optional[list]:
+    '''
+    MaxScore top-k retrieval over the inverted index. Query terms are ordered by their upper
+    bound; once the heap holds k documents, the terms whose bounds together cannot reach the
+    k-th score become non-essential and their postings are no longer visited. Candidates whose
+    bound falls below the k-th score are skipped without being scored.
+
+    Returns the ids of the k best positively scored documents in the same order as an exhaustive
+    search, or None when fewer than k documents score above 0, in which case the caller has to
+    fall back to an exhaustive search to rank the remaining documents. When allowed is given,
+    only the ordinals it marks are scored.
+    '''
+    terms = [term for term in query_vec if term in index.postings]
+    q_norm = norm(list(query_vec.values())) if len(query_vec) > 0 else 0
+    if k <= 0 or q_norm == 0:
+        return None
+    bounds = {term: max(index.upper_bound(term, query_vec[term]) / q_norm, 0) for term in terms}
+    terms.sort(key=lambda term: bounds[term])
+    postings = [index.postings[term] for term in terms]
+    # cumulative[i] bounds the score of a document containing only terms[:i + 1]
+    cumulative = []
+    total = 0
+    for term in terms:
+        total += bounds[term]
+        cumulative.append(total)
+    positions = [0] * len(terms)
+    first_essential = 0
+    heap = []
+    theta = None
+    scored = 0
+    while True:
+        ordinal = min((postings[i][positions[i]] for i in range(first_essential, len(terms))
+                       if positions[i] < len(postings[i])), default=None)
+        if ordinal is None:
+            break
+        bound = cumulative[first_essential - 1] if first_essential > 0 else 0
+        for i in range(first_essential, len(terms)):
+            if positions[i] < len(postings[i]) and postings[i][positions[i]] == ordinal:
+                bound += bounds[terms[i]]
+                positions[i] += 1
+        if allowed is not None and not allowed[ordinal]:
+            continue
+        if theta is not None and bound + PRUNE_EPSILON < theta:
+            continue
+        score = sim(query_vec, doc_db[index.doc_ids[ordinal]])
+        scored += 1
+        if score <= 0:
+            continue
+        # heap entries compare like ranks: lower score, then later ordinal, is worse
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -ordinal))
+        elif (score, -ordinal) > heap[0]:
+            heapq.heapreplace(heap, (score, -ordinal))
+        if len(heap) == k:
+            theta = heap[0][0]
+            while first_essential < len(terms) and cumulative[first_essential] + PRUNE_EPSILON < theta:
+                first_essential += 1
+    if stats is not None:
+        stats["scored"] = scored
+    if len(heap) < k:
+        return None
+    return [index.doc_ids[-neg_ordinal] for _, neg_ordinal in sorted(heap, reverse=True)]
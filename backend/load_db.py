@@ -1,9 +1,13 @@
+import json
+import os
 import pickle
 import argparse
+import time
 from typing import List
 
 from api import remove_repeat_articles
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from backend.custom_types import Rating
@@ -11,11 +15,29 @@ from db_types import *
 from random import random
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from consts import *
+from staging import clear_staging, create_staging_tables, merge_staged
 parser = argparse.ArgumentParser()
 
 parser.add_argument("--percent_upload", type=float, default=0.1)
 parser.add_argument("--n_workers", type=int, default=200)
+parser.add_argument("--bulk", dest="bulk", action="store_true",
+                    help="insert in batches with in-memory ID maps instead of one commit per row")
+parser.set_defaults(bulk=False)
+parser.add_argument("--staging", dest="staging", action="store_true",
+                    help="load stories into staging tables and merge them with set-based INSERT ... SELECT")
+parser.set_defaults(staging=False)
+parser.add_argument("--batch_size", type=int, default=5000,
+                    help="articles per transaction in bulk and staging mode")
+parser.add_argument("--resume", dest="resume", action="store_true",
+                    help="keep existing rows, skip stories already loaded and continue from the last "
+                         "checkpoint; needs --bulk or --staging")
+parser.set_defaults(resume=False)
+parser.add_argument("--checkpoint", type=str, default="load_db_checkpoint.json",
+                    help="file recording the next story to load after each committed batch")
 args = parser.parse_args()
+if args.resume and not (args.bulk or args.staging):
+    # the per-row loader commits stories out of order, so it has no checkpoint to resume from
+    parser.error("--resume needs --bulk or --staging")
 
 percent_articles_to_keep : float = args.percent_upload
 
@@ -66,7 +88,11 @@ def add_news_source(article, session):
             BiasID=determine_bias_id(article)
         )
         session.add(news_source)
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            # another worker added it first
+            session.rollback()
 
 
 def article_not_included(article, session):
@@ -150,7 +176,12 @@ def add_keyword(word: str, session):
         KeyWord=word
     )
     session.add(key_word)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        # another worker added it first
+        session.rollback()
+        key_word = find_keyword(word, session)
     return key_word
 
 
@@ -183,29 +214,205 @@ def process_article(article):
     Session.remove()
 
 
+class IdMap:
+    """
+        In-memory name -> ID map for a lookup table, seeded from the rows already in the
+        database. New names get the next free ID and are queued for insertion. Names are
+        compared by key(name), which has to agree with the unique index of the table.
+        """
+    def __init__(self, rows, key=lambda name: name):
+        self.key = key
+        self.ids = {}
+        self.next_id = 1
+        # the smallest ID wins, like the duplicates merged by migrate.py
+        for id, name in sorted(rows):
+            self.ids.setdefault(key(name), id)
+            self.next_id = id + 1
+        self.pending = []
+
+    def find(self, name: str):
+        return self.ids.get(self.key(name))
+
+    def get(self, name: str, make_row) -> int:
+        id = self.find(name)
+        if id is None:
+            id = self.next_id
+            self.next_id += 1
+            self.ids[self.key(name)] = id
+            self.pending.append(make_row(id, name))
+        return id
+
+    def take_pending(self) -> list:
+        pending = self.pending
+        self.pending = []
+        return pending
+
+
+def read_checkpoint(path: str, num_stories: int) -> int:
+    if path is None or not os.path.exists(path):
+        return 0
+    with open(path) as fp:
+        checkpoint = json.load(fp)
+    if checkpoint["num_stories"] != num_stories:
+        # a different story dump, rely on skipping stories that are already loaded
+        print("Checkpoint is for {} stories, not {}; starting over.".format(checkpoint["num_stories"], num_stories))
+        return 0
+    return checkpoint["next_story"]
+
+
+def write_checkpoint(path: str, next_story: int, num_stories: int) -> None:
+    if path is None:
+        return
+    # write then rename so a crash never leaves a truncated checkpoint
+    with open(path + ".tmp", "w") as fp:
+        json.dump({"next_story": next_story, "num_stories": num_stories}, fp)
+    os.replace(path + ".tmp", path)
+
+
+def bulk_load(articles, session, batch_size: int, start_story: int = 0, checkpoint_path: str = None):
+    start = time.time()
+    rows_inserted = 0
+    skipped = 0
+    # ux_NewsSource_NewsSourceName is case-insensitive under the default collation
+    news_sources = IdMap(session.query(NewsSource.NewsSourceID, NewsSource.NewsSourceName), key=str.casefold)
+    authors = IdMap(session.query(Author.AuthorID, Author.AName))
+    keywords = IdMap(session.query(KeyWord.KeyWordID, KeyWord.KeyWord))
+    next_article_id = (session.query(func.max(Article.ArticleID)).scalar() or 0) + 1
+    loaded = set()
+    loaded_urls = set()
+    for news_source_id, title, url in session.query(Article.NewsSourceID, Article.Aname, Article.URL):
+        loaded.add((news_source_id, title))
+        loaded_urls.add(url)
+
+    for batch_start in range(start_story, len(articles), batch_size):
+        article_rows, wrote_by_rows, has_keyword_rows = [], [], []
+        for article in articles[batch_start:batch_start + batch_size]:
+            if (news_sources.find(article.news_source.name), article.title) in loaded \
+                    or article.url in loaded_urls:
+                skipped += 1
+                continue
+            if random() > percent_articles_to_keep:
+                continue
+            news_source_id = news_sources.get(article.news_source.name, lambda id, name: {
+                "NewsSourceID": id,
+                "NewsSourceName": name,
+                "Homepage": article.news_source.url,
+                "BiasID": determine_bias_id(article)
+            })
+            article_rows.append({
+                "ArticleID": next_article_id,
+                "Aname": article.title,
+                "URL": article.url,
+                "PublishDate": article.publish_date,
+                "NewsSourceID": news_source_id,
+                "ArticleText": article.text,
+                "ArticleSummary": article.summary
+            })
+            for author in article.authors:
+                author_id = authors.get(author, lambda id, name: {"AuthorID": id, "AName": name})
+                wrote_by_rows.append({"ArticleID": next_article_id, "AuthorID": author_id})
+            for word in article.keywords:
+                keyword_id = keywords.get(word, lambda id, name: {"KeyWordID": id, "KeyWord": name})
+                has_keyword_rows.append({"ArticleID": next_article_id, "KeyWordID": keyword_id})
+            loaded.add((news_source_id, article.title))
+            loaded_urls.add(article.url)
+            next_article_id += 1
+
+        # parents before the rows referencing them, one transaction per batch
+        for model, rows in ((NewsSource, news_sources.take_pending()),
+                            (Author, authors.take_pending()),
+                            (KeyWord, keywords.take_pending()),
+                            (Article, article_rows)):
+            if len(rows) > 0:
+                session.bulk_insert_mappings(model, rows)
+                rows_inserted += len(rows)
+        for model, rows in ((WroteBy, wrote_by_rows), (HasKeyWord, has_keyword_rows)):
+            if len(rows) > 0:
+                session.execute(insert_skip_existing(model, session.get_bind().dialect.name), rows)
+                rows_inserted += len(rows)
+        session.commit()
+        next_story = min(batch_start + batch_size, len(articles))
+        write_checkpoint(checkpoint_path, next_story, len(articles))
+        elapsed = time.time() - start
+        print("{n} articles processed, {skipped} already loaded, {rows} rows at {rate:.0f} rows/sec".format(
+            n=next_story, skipped=skipped, rows=rows_inserted, rate=rows_inserted / elapsed))
+    return rows_inserted
+
+
+def staged_load(articles, session, batch_size: int, start_story: int = 0, checkpoint_path: str = None):
+    start = time.time()
+    rows_inserted = 0
+    # leftovers of a batch that never committed
+    clear_staging(session)
+    for batch_start in range(start_story, len(articles), batch_size):
+        story_rows, author_rows, keyword_rows = [], [], []
+        for stage_id, article in enumerate(articles[batch_start:batch_start + batch_size], batch_start):
+            if random() > percent_articles_to_keep:
+                continue
+            story_rows.append({
+                "StageID": stage_id,
+                "NewsSourceName": article.news_source.name,
+                "Homepage": article.news_source.url,
+                "BiasID": determine_bias_id(article),
+                "Title": article.title,
+                "URL": article.url,
+                "PublishDate": article.publish_date,
+                "ArticleText": article.text,
+                "ArticleSummary": article.summary
+            })
+            author_rows.extend({"StageID": stage_id, "AName": author} for author in dict.fromkeys(article.authors))
+            keyword_rows.extend({"StageID": stage_id, "KeyWord": word} for word in dict.fromkeys(article.keywords))
+        for model, rows in ((StagingArticle, story_rows), (StagingAuthor, author_rows), (StagingKeyWord, keyword_rows)):
+            if len(rows) > 0:
+                session.bulk_insert_mappings(model, rows)
+        inserted = merge_staged(session)
+        session.commit()
+        rows_inserted += sum(inserted.values())
+        next_story = min(batch_start + batch_size, len(articles))
+        write_checkpoint(checkpoint_path, next_story, len(articles))
+        elapsed = time.time() - start
+        print("{n} articles processed, {articles} new, {rows} rows at {rate:.0f} rows/sec".format(
+            n=next_story, articles=inserted["Articles"], rows=rows_inserted, rate=rows_inserted / elapsed))
+    return rows_inserted
+
+
 if __name__ == "__main__":
     with open("../stories.pickle", "rb") as fp:
         articles = pickle.load(fp)
     articles = remove_repeat_articles(articles)
-    session = Session()
-    # reset DB
-    session.query(HasKeyWord).delete()
-    session.query(WroteBy).delete()
-    session.query(Article).delete()
-    session.query(NewsSource).delete()
-    session.query(Author).delete()
-    session.commit()
-    Session.remove()
+    if not args.resume:
+        session = Session()
+        # reset DB
+        session.query(HasKeyWord).delete()
+        session.query(WroteBy).delete()
+        session.query(Article).delete()
+        session.query(NewsSource).delete()
+        session.query(Author).delete()
+        session.commit()
+        Session.remove()
+        if os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
 
-    # Process articles in parallel
     print("Processing %d articles" % len(articles))
-    articles_processed = 0
-    with ThreadPoolExecutor(max_workers=args.n_workers) as executor:
-        futures = [executor.submit(process_article, article) for article in articles]
-        for i, future in enumerate(as_completed(futures)):
-            articles_processed += 1
-            if articles_processed % 500 == 0:
-                print("{n} articles processed".format(n=articles_processed))
+    if args.bulk or args.staging:
+        start_story = read_checkpoint(args.checkpoint, len(articles)) if args.resume else 0
+        if start_story > 0:
+            print("Resuming from story %d" % start_story)
+        session = Session()
+        if args.staging:
+            create_staging_tables(engine)
+            staged_load(articles, session, args.batch_size, start_story, args.checkpoint)
+        else:
+            bulk_load(articles, session, args.batch_size, start_story, args.checkpoint)
+        Session.remove()
+    else:
+        # Process articles in parallel
+        articles_processed = 0
+        with ThreadPoolExecutor(max_workers=args.n_workers) as executor:
+            futures = [executor.submit(process_article, article) for article in articles]
+            for i, future in enumerate(as_completed(futures)):
+                articles_processed += 1
+                if articles_processed % 500 == 0:
+                    print("{n} articles processed".format(n=articles_processed))
 
     print("Done!")
-
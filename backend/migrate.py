@@ -0,0 +1,143 @@
+import datetime
+from argparse import ArgumentParser
+from typing import Callable, NamedTuple, Optional
+
+from sqlalchemy import create_engine, delete, func, inspect, select, text, update
+
+from consts import *
+from db_types import *
+
+
+class MigrationError(Exception):
+    pass
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable
+
+
+def canonical_ids(id_column, name_column):
+    return select(name_column.label("name"), func.min(id_column).label("id")).group_by(name_column).subquery()
+
+
+def kept_ids(id_column, name_column):
+    # grouped, so MySQL materializes it and allows it in a DELETE from the same table
+    kept = select(func.min(id_column).label("id")).group_by(name_column).subquery()
+    return select(kept.c.id)
+
+
+def merge_duplicate_keywords(conn) -> None:
+    canonical = canonical_ids(KeyWord.KeyWordID, KeyWord.KeyWord)
+    relinked = select(canonical.c.id, HasKeyWord.ArticleID) \
+        .join(KeyWord, KeyWord.KeyWordID == HasKeyWord.KeyWordID) \
+        .join(canonical, canonical.c.name == KeyWord.KeyWord) \
+        .where(canonical.c.id != HasKeyWord.KeyWordID)
+    conn.execute(insert_skip_existing(HasKeyWord, conn.dialect.name).from_select(["KeyWordID", "ArticleID"], relinked))
+    conn.execute(delete(HasKeyWord).where(HasKeyWord.KeyWordID.notin_(kept_ids(KeyWord.KeyWordID, KeyWord.KeyWord))))
+    conn.execute(delete(KeyWord).where(KeyWord.KeyWordID.notin_(kept_ids(KeyWord.KeyWordID, KeyWord.KeyWord))))
+
+
+def merge_duplicate_news_sources(conn) -> None:
+    canonical = canonical_ids(NewsSource.NewsSourceID, NewsSource.NewsSourceName)
+    canonical_id = select(canonical.c.id) \
+        .join(NewsSource, NewsSource.NewsSourceName == canonical.c.name) \
+        .where(NewsSource.NewsSourceID == Article.NewsSourceID) \
+        .scalar_subquery()
+    duplicates = select(NewsSource.NewsSourceID) \
+        .where(NewsSource.NewsSourceID.notin_(kept_ids(NewsSource.NewsSourceID, NewsSource.NewsSourceName)))
+    conn.execute(update(Article).values(NewsSourceID=canonical_id).where(Article.NewsSourceID.in_(duplicates)))
+    conn.execute(delete(NewsSource).where(
+        NewsSource.NewsSourceID.notin_(kept_ids(NewsSource.NewsSourceID, NewsSource.NewsSourceName))))
+
+
+def create_missing_indexes(conn, indexes) -> None:
+    inspector = inspect(conn)
+    for index in indexes:
+        existing = {existing["name"] for existing in inspector.get_indexes(index.table.name)}
+        if index.name not in existing:
+            index.create(conn)
+
+
+def check_name_lengths(conn, columns, max_length: int) -> None:
+    # a longer name would abort a strict-mode ALTER halfway, or be truncated silently without it
+    too_long = []
+    for column in columns:
+        longest = conn.execute(select(func.max(func.char_length(column)))).scalar()
+        if longest is not None and longest > max_length:
+            too_long.append("{}.{} has names of up to {} characters".format(column.table.name, column.name, longest))
+    if len(too_long) > 0:
+        raise MigrationError("Lookup names must fit in VARCHAR({}): {}. Shorten them and migrate again."
+                             .format(max_length, "; ".join(too_long)))
+
+
+def add_lookup_indexes(conn) -> None:
+    '''
+    Indexes for the date, news source and title lookups on Articles, and indexed VARCHAR lookup
+    names for KeyWord, Author and NewsSource. Keyword and news source names become unique, so
+    duplicates left by earlier concurrent loads are merged into the one with the smallest id first.
+    '''
+    if conn.dialect.name == "mysql":
+        # SQLite column types are not enforced, only MySQL needs the TEXT columns converted
+        check_name_lengths(conn, [KeyWord.__table__.c.KeyWord, Author.__table__.c.AName,
+                                  NewsSource.__table__.c.NewsSourceName], 255)
+        conn.execute(text("ALTER TABLE KeyWord MODIFY KeyWord VARCHAR(255) COLLATE utf8mb4_bin NOT NULL"))
+        conn.execute(text("ALTER TABLE Author MODIFY AName VARCHAR(255) NOT NULL"))
+        conn.execute(text("ALTER TABLE NewsSource MODIFY NewsSourceName VARCHAR(255) NOT NULL"))
+    merge_duplicate_keywords(conn)
+    merge_duplicate_news_sources(conn)
+    create_missing_indexes(conn, list(Article.__table__.indexes) + list(Author.__table__.indexes)
+                           + list(NewsSource.__table__.indexes) + list(KeyWord.__table__.indexes))
+
+
+MIGRATIONS = [
+    Migration(1, "lookup indexes and VARCHAR lookup names", add_lookup_indexes),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def get_schema_version(engine) -> int:
+    SchemaVersion.__table__.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return conn.execute(select(func.max(SchemaVersion.Version))).scalar() or 0
+
+
+def migrate(engine, target: Optional[int] = None) -> list[int]:
+    '''
+    Applies every migration above the recorded schema version, up to target, each in its own
+    transaction. MySQL commits DDL implicitly, so every migration has to be safe to rerun
+    after failing halfway. Returns the versions applied.
+    '''
+    target = LATEST_VERSION if target is None else target
+    current = get_schema_version(engine)
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= current or migration.version > target:
+            continue
+        with engine.begin() as conn:
+            migration.apply(conn)
+            conn.execute(insert(SchemaVersion).values(Version=migration.version, Description=migration.description,
+                                                      AppliedAt=datetime.datetime.now()))
+        print("Applied migration {}: {}".format(migration.version, migration.description))
+        applied.append(migration.version)
+    return applied
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--db_url", type=str, default="mysql+pymysql://db_final:password@" + AWS_IP + "/db_final_db")
+    parser.add_argument("--target", type=int, default=None, help="version to migrate to, the latest by default")
+    args = parser.parse_args()
+    engine = create_engine(args.db_url)
+    print("Schema version {}".format(get_schema_version(engine)))
+    try:
+        applied = migrate(engine, args.target)
+    except MigrationError as e:
+        raise SystemExit(str(e))
+    if len(applied) == 0:
+        print("Nothing to apply")
+
+
+if __name__ == "__main__":
+    main()
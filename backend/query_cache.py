@@ -0,0 +1,175 @@
+from collections import Counter, OrderedDict
+from threading import RLock
+from typing import Iterable, NamedTuple, Optional
+
+from sqlitedict import SqliteDict
+
+from utils import BagOfWordsVector
+
+
+class CachedResult(NamedTuple):
+    generation: int
+    results: list
+
+
+class QueryIndex:
+    '''
+    Term -> cached query inverted index over the vectors stored in query_map.db. Looking up a
+    similar query only compares against cached queries sharing a term with it, using the
+    stored vectors instead of re-tokenizing every cached query string.
+    '''
+
+    def __init__(self, query_pairs: Iterable[tuple[str, BagOfWordsVector]] = ()):
+        self.vectors: dict[str, BagOfWordsVector] = {}
+        self.postings: dict[str, set[str]] = {}
+        # insertion sequence of every query, used to break ties in lookups
+        self.positions: dict[str, int] = {}
+        self._next_position = 0
+        for query, vector in query_pairs:
+            self.add(query, vector)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __contains__(self, query: str):
+        return query in self.vectors
+
+    def add(self, query: str, vector: BagOfWordsVector) -> None:
+        if query in self.vectors:
+            self.remove(query)
+        self.vectors[query] = vector
+        self.positions[query] = self._next_position
+        self._next_position += 1
+        for term in vector:
+            self.postings.setdefault(term, set()).add(query)
+
+    def remove(self, query: str) -> None:
+        vector = self.vectors.pop(query, None)
+        if vector is None:
+            return
+        del self.positions[query]
+        for term in vector:
+            queries = self.postings.get(term)
+            if queries is not None:
+                queries.discard(query)
+                if len(queries) == 0:
+                    del self.postings[term]
+
+    def candidates(self, query_vec: BagOfWordsVector) -> list[tuple[str, BagOfWordsVector]]:
+        '''
+        (<query>, <vector>) pairs of cached queries sharing a term with query_vec, in insertion order
+        '''
+        matches = set()
+        for term in query_vec:
+            matches.update(self.postings.get(term, ()))
+        return [(query, self.vectors[query]) for query in sorted(matches, key=self.positions.__getitem__)]
+
+
+class QueryCache:
+    '''
+    Size-bounded LRU cache of query vectors (query_map.db) and their ranked results
+    (queries.db). Results are tagged with the generation of the document index they were
+    computed against, and results from any other generation are dropped when read, so rebuilding
+    the index invalidates the cache without clearing it. Once more than max_entries queries are
+    cached the least recently used ones are evicted from both files. The search threads share
+    one cache, so every method holds its lock.
+    '''
+
+    def __init__(self, results_path: str, vectors_path: str, generation: int, max_entries: int):
+        self.results_db = SqliteDict(results_path)
+        self.vectors_db = SqliteDict(vectors_path)
+        self.generation = generation
+        self.max_entries = max_entries
+        self.index = QueryIndex(self.vectors_db.items())
+        # least recently used first; SqliteDict iterates in write order
+        self.lru = OrderedDict((query, None) for query in self.index.vectors)
+        self.counters = Counter(hits=0, misses=0, evictions=0, invalidations=0)
+        self.lock = RLock()
+        self.evict()
+
+    def __len__(self):
+        return len(self.lru)
+
+    def __contains__(self, query: str):
+        return query in self.lru
+
+    def get(self, query: str) -> Optional[tuple[list, BagOfWordsVector]]:
+        '''
+        (<results>, <query vector>) for a query cached in the current generation
+        '''
+        with self.lock:
+            try:
+                cached = self.results_db[query]
+                vector = self.vectors_db[query]
+            except KeyError:
+                self.counters["misses"] += 1
+                return None
+            if not isinstance(cached, CachedResult) or cached.generation != self.generation:
+                del self.results_db[query]
+                self.results_db.commit()
+                self.counters["invalidations"] += 1
+                self.counters["misses"] += 1
+                return None
+            self.lru.move_to_end(query)
+            self.counters["hits"] += 1
+            return cached.results, vector
+
+    def get_vector(self, query: str) -> Optional[BagOfWordsVector]:
+        with self.lock:
+            if query not in self.lru:
+                return None
+            self.lru.move_to_end(query)
+            return self.vectors_db[query]
+
+    def candidates(self, query_vec: BagOfWordsVector) -> list[tuple[str, BagOfWordsVector]]:
+        with self.lock:
+            return self.index.candidates(query_vec)
+
+    def put_vector(self, query: str, vector: BagOfWordsVector) -> None:
+        with self.lock:
+            self.vectors_db[query] = vector
+            self.vectors_db.commit()
+            self.index.add(query, vector)
+            self.lru[query] = None
+            self.lru.move_to_end(query)
+            self.evict()
+
+    def put(self, query: str, vector: BagOfWordsVector, results: list) -> None:
+        with self.lock:
+            self.results_db[query] = CachedResult(self.generation, results)
+            self.results_db.commit()
+            self.put_vector(query, vector)
+
+    def remove(self, query: str) -> None:
+        with self.lock:
+            self.lru.pop(query, None)
+            self.index.remove(query)
+            for db in (self.results_db, self.vectors_db):
+                if query in db:
+                    del db[query]
+
+    def evict(self) -> None:
+        with self.lock:
+            evicted = False
+            while len(self.lru) > self.max_entries:
+                query = next(iter(self.lru))
+                self.remove(query)
+                self.counters["evictions"] += 1
+                evicted = True
+            if evicted:
+                self.results_db.commit()
+                self.vectors_db.commit()
+
+    def set_generation(self, generation: int) -> None:
+        # results of the previous generation are dropped on their next read
+        with self.lock:
+            self.generation = generation
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters, entries=len(self), max_entries=self.max_entries,
+                        generation=self.generation)
+
+    def close(self) -> None:
+        self.results_db.close()
+        self.vectors_db.close()
@@ -0,0 +1,111 @@
+import bisect
+import pickle
+from datetime import datetime
+from typing import Iterable, Optional
+
+import numpy as np
+
+from index import InvertedIndex
+from utils import DocFreqs
+
+
+class Segment:
+    '''
+    Documents published in one month. ordinals are their positions in the document store, in
+    store order, and the segment's inverted index lists them in the same order so ties are
+    broken as in the unsegmented index.
+    '''
+
+    def __init__(self, month: str, ordinals: np.ndarray, min_date: datetime, max_date: datetime,
+                 index: InvertedIndex):
+        self.month = month
+        self.ordinals = ordinals
+        self.min_date = min_date
+        self.max_date = max_date
+        self.index = index
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def overlaps(self, after: Optional[datetime], before: Optional[datetime]) -> bool:
+        # the bounds are strict, like the WRITTEN AFTER and WRITTEN BEFORE conditions
+        return (after is None or self.max_date > after) and (before is None or self.min_date < before)
+
+
+class SegmentedIndex:
+    '''
+    The document index partitioned by month of publication, with the date range of every
+    segment, so a date-bounded query only reads the segments that overlap its range. Undated
+    documents are in no segment; they never satisfy a date bound. Documents are appended to
+    the segment of their month, and a month not seen before gets a new segment.
+    '''
+
+    def __init__(self, segments: Optional[list[Segment]] = None, doc_ids: Iterable = ()):
+        self.segments = segments if segments is not None else []
+        self.ordinal_of = {doc_id: ordinal for ordinal, doc_id in enumerate(doc_ids)}
+        self.doc_freqs: Optional[DocFreqs] = None
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __getstate__(self):
+        # doc_freqs is saved in index_meta.db
+        return dict(self.__dict__, doc_freqs=None)
+
+    def num_docs(self) -> int:
+        return len(self.ordinal_of)
+
+    def overlapping(self, after: Optional[datetime], before: Optional[datetime]) -> list[Segment]:
+        return [segment for segment in self.segments if segment.overlaps(after, before)]
+
+    def set_doc_freqs(self, doc_freqs: Optional[DocFreqs]) -> None:
+        self.doc_freqs = doc_freqs
+        for segment in self.segments:
+            segment.index.set_doc_freqs(doc_freqs)
+
+    def append(self, docs: Iterable[tuple]) -> None:
+        '''
+        docs must be (<doc_id>, <term frequencies>, <publish date>) tuples in store order,
+        following every document already in the index
+        '''
+        by_month: dict[str, list[tuple]] = {}
+        for doc_id, tf, publish_date in docs:
+            ordinal = len(self.ordinal_of)
+            self.ordinal_of[doc_id] = ordinal
+            if publish_date is not None:
+                by_month.setdefault(publish_date.strftime("%Y-%m"), []).append((ordinal, doc_id, tf, publish_date))
+        months = [segment.month for segment in self.segments]
+        for month, month_docs in by_month.items():
+            position = bisect.bisect_left(months, month)
+            if position < len(months) and months[position] == month:
+                segment = self.segments[position]
+            else:
+                index = InvertedIndex()
+                index.set_doc_freqs(self.doc_freqs)
+                segment = Segment(month, np.zeros(0, dtype=np.int64), month_docs[0][3], month_docs[0][3], index)
+                self.segments.insert(position, segment)
+                months.insert(position, month)
+            for ordinal, doc_id, tf, publish_date in month_docs:
+                segment.index.add_document(doc_id, tf)
+                segment.min_date = min(segment.min_date, publish_date)
+                segment.max_date = max(segment.max_date, publish_date)
+            segment.ordinals = np.concatenate((segment.ordinals,
+                                               np.array([doc[0] for doc in month_docs], dtype=np.int64)))
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as fp:
+            pickle.dump(self, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path: str) -> "SegmentedIndex":
+        with open(path, "rb") as fp:
+            return pickle.load(fp)
+
+
+def build_segments(docs: Iterable[tuple]) -> SegmentedIndex:
+    '''
+    docs must be (<doc_id>, <term frequencies>, <publish date>) tuples in store order
+    '''
+    segments = SegmentedIndex()
+    segments.append(docs)
+    return segments
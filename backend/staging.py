@@ -0,0 +1,99 @@
+from sqlalchemy import and_, delete, func, insert, or_, select, update
+
+from db_types import *
+
+STAGING_TABLES = [StagingArticle.__table__, StagingAuthor.__table__, StagingKeyWord.__table__]
+
+
+def create_staging_tables(engine) -> None:
+    Base.metadata.create_all(engine, tables=STAGING_TABLES, checkfirst=True)
+
+
+def first_ids(id_column, name_column):
+    '''
+    (<name>, <smallest id>) rows, so names that were inserted twice by older loaders map to one id
+    '''
+    return select(name_column.label("name"), func.min(id_column).label("id")).group_by(name_column).subquery()
+
+
+def clear_staging(session) -> None:
+    for model in (StagingKeyWord, StagingAuthor, StagingArticle):
+        session.execute(delete(model))
+
+
+def merge_staged(session) -> dict:
+    '''
+    Merge the staged stories into NewsSource, Author, KeyWord, Articles, WroteBy and HasKeyWord
+    with one INSERT ... SELECT per table, letting auto_increment hand out the ids. Stories
+    already loaded, by news source and title or by URL, are not inserted again, and link rows
+    that already exist are skipped, so merging the same stories twice changes nothing.
+    This is the same merge as the MergeStagedStories procedure in DatabaseFinalProject.sql.
+
+    The staging tables are emptied afterwards; the caller owns the transaction.
+    Returns the number of rows inserted into each table.
+    '''
+    inserted = {}
+
+    new_sources = select(StagingArticle.NewsSourceName, func.min(StagingArticle.Homepage),
+                         func.min(StagingArticle.BiasID)) \
+        .where(~select(NewsSource.NewsSourceID)
+               .where(NewsSource.NewsSourceName == StagingArticle.NewsSourceName).exists()) \
+        .group_by(StagingArticle.NewsSourceName)
+    inserted["NewsSource"] = session.execute(insert(NewsSource).from_select(
+        ["NewsSourceName", "Homepage", "BiasID"], new_sources)).rowcount
+
+    new_authors = select(StagingAuthor.AName).distinct() \
+        .where(~select(Author.AuthorID).where(Author.AName == StagingAuthor.AName).exists())
+    inserted["Author"] = session.execute(insert(Author).from_select(["AName"], new_authors)).rowcount
+
+    new_keywords = select(StagingKeyWord.KeyWord).distinct() \
+        .where(~select(KeyWord.KeyWordID).where(KeyWord.KeyWord == StagingKeyWord.KeyWord).exists())
+    inserted["KeyWord"] = session.execute(insert(KeyWord).from_select(["KeyWord"], new_keywords)).rowcount
+
+    # the first staged copy of each (news source, title), in staging order
+    source_ids = first_ids(NewsSource.NewsSourceID, NewsSource.NewsSourceName)
+    first_stages = select(func.min(StagingArticle.StageID)) \
+        .group_by(StagingArticle.NewsSourceName, StagingArticle.Title)
+    new_articles = select(StagingArticle.Title, StagingArticle.URL, StagingArticle.PublishDate,
+                          source_ids.c.id, StagingArticle.ArticleText, StagingArticle.ArticleSummary) \
+        .join(source_ids, source_ids.c.name == StagingArticle.NewsSourceName) \
+        .where(StagingArticle.StageID.in_(first_stages)) \
+        .where(~select(Article.ArticleID)
+               .where(or_(and_(Article.NewsSourceID == source_ids.c.id, Article.Aname == StagingArticle.Title),
+                          Article.URL == StagingArticle.URL)).exists()) \
+        .order_by(StagingArticle.StageID)
+    inserted["Articles"] = session.execute(insert(Article).from_select(
+        ["Aname", "URL", "PublishDate", "NewsSourceID", "ArticleText", "ArticleSummary"], new_articles)).rowcount
+
+    # record which article every staged story ended up as, new or already loaded
+    article_ids = select(func.min(Article.ArticleID)) \
+        .join(NewsSource, NewsSource.NewsSourceID == Article.NewsSourceID) \
+        .where(NewsSource.NewsSourceName == StagingArticle.NewsSourceName, Article.Aname == StagingArticle.Title) \
+        .scalar_subquery()
+    session.execute(update(StagingArticle).values(ArticleID=article_ids))
+
+    author_ids = first_ids(Author.AuthorID, Author.AName)
+    new_wrote_by = select(StagingArticle.ArticleID, author_ids.c.id).distinct() \
+        .select_from(StagingAuthor) \
+        .join(StagingArticle, StagingArticle.StageID == StagingAuthor.StageID) \
+        .join(author_ids, author_ids.c.name == StagingAuthor.AName) \
+        .where(StagingArticle.ArticleID.isnot(None)) \
+        .where(~select(WroteBy.ArticleID)
+               .where(WroteBy.ArticleID == StagingArticle.ArticleID, WroteBy.AuthorID == author_ids.c.id).exists())
+    inserted["WroteBy"] = session.execute(insert(WroteBy).from_select(
+        ["ArticleID", "AuthorID"], new_wrote_by)).rowcount
+
+    keyword_ids = first_ids(KeyWord.KeyWordID, KeyWord.KeyWord)
+    new_has_keyword = select(keyword_ids.c.id, StagingArticle.ArticleID).distinct() \
+        .select_from(StagingKeyWord) \
+        .join(StagingArticle, StagingArticle.StageID == StagingKeyWord.StageID) \
+        .join(keyword_ids, keyword_ids.c.name == StagingKeyWord.KeyWord) \
+        .where(StagingArticle.ArticleID.isnot(None)) \
+        .where(~select(HasKeyWord.ArticleID)
+               .where(HasKeyWord.ArticleID == StagingArticle.ArticleID,
+                      HasKeyWord.KeyWordID == keyword_ids.c.id).exists())
+    inserted["HasKeyWord"] = session.execute(insert(HasKeyWord).from_select(
+        ["KeyWordID", "ArticleID"], new_has_keyword)).rowcount
+
+    clear_staging(session)
+    return inserted
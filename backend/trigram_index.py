@@ -0,0 +1,67 @@
+from typing import Iterable
+
+GRAM_SIZE = 3
+
+
+def grams(text: str) -> set[str]:
+    return {text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}
+
+
+class TrigramIndex:
+    '''
+    Case-insensitive substring index from names (keywords, authors, news sources, titles) to the
+    articles they belong to, matching the same articles as LIKE '%<token>%' over the name column.
+    A token of at least three characters is looked up by intersecting the postings of its
+    trigrams and checking the few remaining names; shorter tokens are matched against the
+    distinct trigrams and the names too short to have one. Neither depends on the number of
+    articles.
+    '''
+
+    def __init__(self, rows: Iterable[tuple[str, int]] = ()):
+        self.names: list[str] = []
+        self.article_ids: list[list[int]] = []
+        self.name_ids: dict[str, int] = {}
+        self.postings: dict[str, set[int]] = {}
+        self.short_names: list[int] = []
+        for name, article_id in rows:
+            self.add(name, article_id)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name: str, article_id: int) -> None:
+        name = name.lower()
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.name_ids[name] = name_id
+            self.names.append(name)
+            self.article_ids.append([])
+            name_grams = grams(name)
+            if len(name_grams) == 0:
+                self.short_names.append(name_id)
+            for gram in name_grams:
+                self.postings.setdefault(gram, set()).add(name_id)
+        self.article_ids[name_id].append(article_id)
+
+    def matching_names(self, token: str) -> list[int]:
+        token = token.lower()
+        if len(token) >= GRAM_SIZE:
+            postings = sorted((self.postings.get(gram, set()) for gram in grams(token)), key=len)
+            candidates = set.intersection(*postings)
+        else:
+            candidates = set()
+            for gram, name_ids in self.postings.items():
+                if token in gram:
+                    candidates.update(name_ids)
+            candidates.update(self.short_names)
+        return sorted(name_id for name_id in candidates if token in self.names[name_id])
+
+    def search(self, token: str) -> list[int]:
+        '''
+        ArticleIDs of every name containing token, once per matching name like the SQL join
+        '''
+        article_ids = []
+        for name_id in self.matching_names(token):
+            article_ids.extend(self.article_ids[name_id])
+        return article_ids
@@ -1,4 +1,8 @@
+import hashlib
 from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain
 from datetime import datetime
 from typing import Iterable, Optional, NamedTuple, Union
 
@@ -10,7 +14,7 @@ from tqdm import tqdm
 
 from consts import ratings_dict
 from db_types  import *
-from sqlalchemy import select, create_engine
+from sqlalchemy import and_, bindparam, select, create_engine
 
 from condition_parser import *
 import re
@@ -95,6 +99,23 @@ def cosine_sim(x, y):
     return num / (norm(list(x.values())) * norm(list(y.values())))
 
 
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    '''
+    Indices of the k largest scores in descending order of score. Equal scores keep ascending
+    index order, so the result matches the first k entries of a stable descending sort.
+    '''
+    n = len(scores)
+    if k >= n:
+        return np.argsort(-scores, kind="stable")
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    kth_largest = np.partition(scores, n - k)[n - k]
+    above = np.flatnonzero(scores > kth_largest)
+    ties = np.flatnonzero(scores == kth_largest)[:k - len(above)]
+    selected = np.concatenate((above, ties))
+    return selected[np.argsort(-scores[selected], kind="stable")]
+
+
 class ArticleWeights(NamedTuple):
     authors: int
     keywords: int
@@ -130,9 +151,15 @@ def process_query(sentence: str):
 
 
 class DocFreqs(Counter):
-    def __init__(self):
+    def __init__(self, counts=None, num_docs=0):
         super(DocFreqs, self).__init__()
-        self.num_docs = 0
+        if counts is not None:
+            self.update(counts)
+        self.num_docs = num_docs
+
+    def __reduce__(self):
+        # Counter only pickles the counts, keep the document count when sent to worker processes
+        return self.__class__, (dict(self), self.num_docs)
 
     def set_num_docs(self, n):
         self.num_docs = n
@@ -140,6 +167,19 @@ class DocFreqs(Counter):
     def get_num_docs(self):
         return self.num_docs
 
+    def merge(self, other: "DocFreqs") -> "DocFreqs":
+        self.update(other)
+        self.num_docs += other.get_num_docs()
+        return self
+
+    def idf(self, term: str) -> float:
+        return np.log(self.num_docs / (1 + self[term]))
+
+    def idfs(self, terms: Iterable[str]) -> np.ndarray:
+        terms = list(terms)
+        df = np.fromiter((self[term] for term in terms), dtype=np.int64, count=len(terms))
+        return np.log(self.num_docs / (1 + df))
+
 
 class ArticleData(NamedTuple):
     title: Iterable[str]
@@ -152,6 +192,29 @@ class ArticleData(NamedTuple):
         return [self.title, self.summary, self.author, self.publisher]
 
 
+class RawArticle(NamedTuple):
+    title: str
+    summary: str
+    author: list[str]
+    publisher: list[str]
+    keywords: list[str]
+
+
+class ArticleTokens(NamedTuple):
+    content_hash: str
+    title: list[str]
+    summary: list[str]
+
+
+# bump whenever tokenize_string changes so cached tokens are not reused
+TOKENIZER_VERSION = 1
+
+
+def article_content_hash(article: RawArticle) -> str:
+    content = "\0".join((str(TOKENIZER_VERSION), article.title or "", article.summary or ""))
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
 class ArticleDataWeights(NamedTuple):
     title: float
     summary: float
@@ -160,6 +223,9 @@ class ArticleDataWeights(NamedTuple):
     keywords: float
 
 
+default_article_weights = ArticleDataWeights(author=5, keywords=3, summary=1, title=4, publisher=5)
+
+
 def compute_doc_freq(documents: Iterable[ArticleData]) -> DocFreqs:
     '''
     Computes document frequency, i.e. how many documents contain a specific word
@@ -193,32 +259,159 @@ def compute_tf(doc: ArticleData, weights: ArticleDataWeights):
     return dict(vec)
 
 
-def compute_tfidf(doc: ArticleData, doc_freqs: DocFreqs, weights: ArticleDataWeights):
-    tf = compute_tf(doc, weights)
+def weight_tf(tf: BagOfWordsVector, doc_freqs: DocFreqs) -> BagOfWordsVector:
     tf_idf = {}
-    n = doc_freqs.get_num_docs()
     for word in tf.keys():
-        tf_idf[word] = tf[word] * np.log(n / (1 + doc_freqs[word]))
+        tf_idf[word] = tf[word] * doc_freqs.idf(word)
     return tf_idf
 
 
-def generate_doc_tfidfs(docs: Iterable[ArticleData], weights: ArticleDataWeights,
-                        verbose=True) -> list[BagOfWordsVector]:
-    doc_freqs = compute_doc_freq(docs)
-    vectors = []
+def compute_tfidf(doc: ArticleData, doc_freqs: DocFreqs, weights: ArticleDataWeights):
+    return weight_tf(compute_tf(doc, weights), doc_freqs)
+
+
+def intern_terms(terms: Iterable[str], term_ids: dict[str, int], count: int) -> np.ndarray:
+    return np.fromiter((term_ids.setdefault(term, len(term_ids)) for term in terms),
+                       dtype=np.int64, count=count)
+
+
+def rows_to_vectors(vocab: list[str], indptr: np.ndarray, cols: np.ndarray,
+                    values: np.ndarray) -> list[BagOfWordsVector]:
+    terms = np.array(vocab, dtype=object)[cols].tolist()
+    values = values.tolist()
+    bounds = indptr.tolist()
+    return [dict(zip(terms[start:end], values[start:end])) for start, end in zip(bounds, bounds[1:])]
+
+
+def generate_doc_tfs(docs: list[ArticleData],
+                     weights: ArticleDataWeights) -> tuple[DocFreqs, list[BagOfWordsVector]]:
+    '''
+    Document frequencies and weighted term frequencies, i.e. everything but idf. Equivalent to
+    compute_doc_freq and compute_tf, but every field is counted as one sparse document x term
+    matrix and the field weights are applied with array operations.
+    '''
+    n = len(docs)
+    term_ids = {}
+    rows, cols, token_weights, in_sections = [], [], [], []
+    # ArticleData field order, which is also the order compute_tf adds terms in
+    for field in ArticleData._fields:
+        tokens = [getattr(doc, field) for doc in docs]
+        lengths = np.fromiter((len(field_tokens) for field_tokens in tokens), dtype=np.int64, count=n)
+        rows.append(np.repeat(np.arange(n), lengths))
+        cols.append(intern_terms(chain.from_iterable(tokens), term_ids, int(lengths.sum())))
+        token_weights.append(np.full(int(lengths.sum()), getattr(weights, field), dtype=np.float64))
+        # compute_doc_freq only looks at ArticleData.sections(), i.e. not at keywords
+        in_sections.append(np.full(int(lengths.sum()), field != "keywords"))
+    vocab = list(term_ids)
+    n_terms = max(len(vocab), 1)
+    # row-major with every row in field, then token order
+    order = np.argsort(np.concatenate(rows), kind="stable")
+    keys = np.concatenate(rows)[order] * n_terms + np.concatenate(cols)[order]
+    token_weights = np.concatenate(token_weights)[order]
+    in_sections = np.concatenate(in_sections)[order]
+
+    entries, first_seen, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    # bincount adds weights in token order, like compute_tf does
+    tf = np.bincount(inverse.ravel(), weights=token_weights, minlength=len(entries))
+    by_first_seen = np.argsort(first_seen, kind="stable")
+    entries = entries[by_first_seen]
+    tf = tf[by_first_seen]
+    indptr = np.searchsorted(entries // n_terms, np.arange(n + 1))
+
+    df = np.bincount(np.unique(keys[in_sections]) % n_terms, minlength=len(vocab))
+    doc_freqs = DocFreqs({vocab[i]: int(df[i]) for i in np.flatnonzero(df)}, n)
+    return doc_freqs, rows_to_vectors(vocab, indptr, entries % n_terms, tf)
+
+
+def analyze_article(article: Union[RawArticle, ArticleData]) -> ArticleData:
+    if isinstance(article, ArticleData):
+        # tokens already came from the token cache
+        return article
+    return ArticleData(
+        title=list(tokenize_string(article.title)),
+        summary=list(tokenize_string(article.summary)),
+        author=article.author,
+        publisher=article.publisher,
+        keywords=article.keywords
+    )
+
+
+def analyze_shard(articles: list[Union[RawArticle, ArticleData]],
+                  weights: ArticleDataWeights) -> tuple[list[ArticleData], DocFreqs, list[BagOfWordsVector]]:
+    docs = [analyze_article(article) for article in articles]
+    doc_freqs, tfs = generate_doc_tfs(docs, weights)
+    return docs, doc_freqs, tfs
+
+
+def analyze_articles(articles: list[Union[RawArticle, ArticleData]], weights: ArticleDataWeights,
+                     n_workers: int = 1) -> tuple[list[ArticleData], DocFreqs, list[BagOfWordsVector]]:
+    '''
+    Tokenizes articles and counts their terms. Articles given as ArticleData are already
+    tokenized and only counted. With more than one worker, contiguous shards are
+    analyzed in a process pool and the partial document frequencies are merged in shard order,
+    which gives the same output as the serial path.
+    '''
+    if n_workers <= 1 or len(articles) < 2:
+        return analyze_shard(articles, weights)
+    # a few shards per worker so one slow shard does not hold up the pool
+    n_shards = min(len(articles), 4 * n_workers)
+    shard_size = -(-len(articles) // n_shards)
+    shards = [articles[i:i + shard_size] for i in range(0, len(articles), shard_size)]
+    docs = []
+    doc_freqs = DocFreqs()
+    tfs = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for shard_docs, shard_freqs, shard_tfs in executor.map(analyze_shard, shards,
+                                                               [weights] * len(shards)):
+            docs.extend(shard_docs)
+            doc_freqs.merge(shard_freqs)
+            tfs.extend(shard_tfs)
+    return docs, doc_freqs, tfs
+
+
+def weight_tfs(tfs: list[BagOfWordsVector], doc_freqs: DocFreqs,
+               verbose=True) -> list[BagOfWordsVector]:
+    '''
+    Applies idf to every term frequency vector, equivalent to weight_tf on each of them. The
+    vectors are flattened into one sparse matrix and scaled by a single idf vector.
+    '''
     if verbose:
         print("Preprocessing: generating document vectors...")
-        for doc in tqdm(docs):
-            vectors.append(compute_tfidf(doc, doc_freqs, weights))
-    else:
-        for doc in docs:
-            vectors.append(compute_tfidf(doc, doc_freqs, weights))
-    return vectors
+    lengths = np.fromiter((len(tf) for tf in tfs), dtype=np.int64, count=len(tfs))
+    n_entries = int(lengths.sum())
+    term_ids = {}
+    cols = intern_terms(chain.from_iterable(tfs), term_ids, n_entries)
+    values = np.fromiter(chain.from_iterable(tf.values() for tf in tfs), dtype=np.float64, count=n_entries)
+    idf = doc_freqs.idfs(term_ids)
+    indptr = np.concatenate(([0], np.cumsum(lengths)))
+    return rows_to_vectors(list(term_ids), indptr, cols, values * idf[cols])
 
 
 class QueryCondition():
+    '''
+    A condition compiles to a SQL clause over Article and NewsSource whose values are bind
+    parameters named after key, so conditions of the same shape share one statement and only
+    their bind_values differ.
+    '''
+    def clause(self, key: str):
+        return None
+
+    def bind_values(self, key: str) -> dict:
+        return {}
+
+    def shape(self) -> tuple:
+        return (type(self).__name__,)
+
     def apply(self, statement):
-        return NotImplementedError
+        key = "condition_{}".format(id(self))
+        clause = self.clause(key)
+        if clause is None:
+            return statement
+        return statement.where(clause).params(**self.bind_values(key))
+
+    def mask(self, filters):
+        # documents matching the condition in a DocumentFilters, None if it filters nothing
+        return None
 
 
 class BeforeCondition(QueryCondition):
@@ -226,8 +419,14 @@ class BeforeCondition(QueryCondition):
     def __init__(self, date: datetime):
         self.date = date
 
-    def apply(self, statement):
-        return statement.where(Article.PublishDate < self.date)
+    def clause(self, key: str):
+        return Article.PublishDate < bindparam(key)
+
+    def bind_values(self, key: str) -> dict:
+        return {key: self.date}
+
+    def mask(self, filters):
+        return filters.date_mask(before=self.date)
 
 
 class AfterCondition(QueryCondition):
@@ -235,8 +434,14 @@ class AfterCondition(QueryCondition):
     def __init__(self, date: datetime):
         self.date = date
 
-    def apply(self, statement):
-        return statement.where(Article.PublishDate > self.date)
+    def clause(self, key: str):
+        return Article.PublishDate > bindparam(key)
+
+    def bind_values(self, key: str) -> dict:
+        return {key: self.date}
+
+    def mask(self, filters):
+        return filters.date_mask(after=self.date)
 
 
 class AuthorCondition(QueryCondition):
@@ -244,40 +449,63 @@ class AuthorCondition(QueryCondition):
     def __init__(self, authors_list):
         self.authors = authors_list
 
-    def apply(self, statement):
+    def clause(self, key: str):
+        if len(self.authors) == 0:
+            return None
+        # one correlated semi-join per author, the article has to be written by all of them
+        return and_(*(
+            select(WroteBy.ArticleID)
+            .join(Author, Author.AuthorID == WroteBy.AuthorID)
+            .where(WroteBy.ArticleID == Article.ArticleID, Author.AName == bindparam("{}_{}".format(key, i)))
+            .exists()
+            for i in range(len(self.authors))
+        ))
+
+    def bind_values(self, key: str) -> dict:
+        return {"{}_{}".format(key, i): author for i, author in enumerate(self.authors)}
+
+    def shape(self) -> tuple:
+        return type(self).__name__, len(self.authors)
+
+    def mask(self, filters):
+        # written by every listed author
+        mask = None
         for author in self.authors:
-            statement = statement.where(
-                select(Author)
-                    .join(WroteBy)
-                    .where(Author.AName == author and Article.ArticleID == WroteBy.ArticleID)
-                    .exists()
-            )
-        return statement
+            author_mask = filters.author_mask(author)
+            mask = author_mask if mask is None else mask & author_mask
+        return mask
 
 
 class NewsSourceCondition(QueryCondition):
     def __init__(self, publisher):
         self.publisher = publisher
 
-    def apply(self, statement):
-        return statement.where(
-            NewsSource.NewsSourceName == self.publisher
-        )
+    def clause(self, key: str):
+        return NewsSource.NewsSourceName == bindparam(key)
+
+    def bind_values(self, key: str) -> dict:
+        return {key: self.publisher}
+
+    def mask(self, filters):
+        return filters.publisher_mask(self.publisher)
 
 
 class BiasRatingCondition(QueryCondition):
     def __init__(self, bias):
         self.bias_id = ratings_dict[bias]
 
-    def apply(self, statement):
-        return statement.where(
-            NewsSource.BiasID == self.bias_id
-        )
+    def clause(self, key: str):
+        return NewsSource.BiasID == bindparam(key)
+
+    def bind_values(self, key: str) -> dict:
+        return {key: self.bias_id}
+
+    def mask(self, filters):
+        return filters.bias_mask(self.bias_id)
 
 
 class NullQueryCondition(QueryCondition):
-    def apply(self, statement):
-        return statement
+    pass
 
 
 condition_pattern = re.compile("`.*`")
@@ -285,7 +513,7 @@ condition_pattern = re.compile("`.*`")
 
 def create_written_by_condition(raw_author_list: list[str]) -> AuthorCondition:
     authors = []
-    for author_name in author_list:
+    for author_name in raw_author_list:
         if author_name != AND_TOKEN:
             authors.append(author_name)
     return AuthorCondition(authors)
@@ -324,13 +552,24 @@ def create_condition_object(raw_condition: list) -> QueryCondition:
         return NullQueryCondition()
 
 
+# distinct condition strings whose parsed conditions are kept
+CONDITION_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=CONDITION_CACHE_SIZE)
+def parse_query_conditions(conditions: str) -> tuple[QueryCondition, ...]:
+    '''
+    Conditions of a backtick-delimited condition string. Queries repeat the same few condition
+    strings, and conditions are never modified once built, so they are memoized and shared.
+    '''
+    return tuple(create_condition_object(raw_condition) for raw_condition in parse_condition_list(conditions))
+
+
 def extract_query_conditions(q: str) -> tuple[str, list[QueryCondition]]:
     match = condition_pattern.search(q)
     to_apply = []
     if match is not None:
-        conditions = condition_list.parseString(q[match.span()[0]:match.span()[1]])
-        for i in range(1, len(conditions) - 1):
-            to_apply.append(create_condition_object(conditions[i]))
+        to_apply = list(parse_query_conditions(q[match.span()[0]:match.span()[1]]))
         q = q[0:match.span()[0]] + q[match.span()[1]:len(q)]
     return q, to_apply
 